@@ -0,0 +1,120 @@
+# Benchmark of html2latex in squid_utils against the previous implementation (kept below as html2latex_old),
+# which made a new parser class for every call and converted every unknown tag (e.g. "<" in math) recursively.
+#
+# Run with:  python benchmark_html2latex.py
+
+import timeit
+from html.parser import HTMLParser
+from squid_utils import (html2latex, convert_many, html2latex_cache, Html2LatexParser, img_width2latex,
+    img_height2latex)
+
+def html2latex_old(text, verbose=False):
+    '''The html2latex of Squid before the single-pass converter, for comparison.'''
+    output = []  # list of strings, to be joined later
+    # ignore_tags will be ignored, i.e. their tag name and attributes will be excluded:
+    ignored_tags = ['td', 'tr', 'th', 'thead', 'table', 'head', 'body', 'meta', 'html', 'tbody', 'title', 'script',
+                    'div', 'span', 'link', 'header', 'h5', 'style', 'font']
+    class myparser(HTMLParser):
+        def handle_starttag(self, tag, attrs):
+            nonlocal output  # we'll be modifying this as we go
+            if tag == 'img':
+                wh = []
+                for key, value in attrs:
+                    if key == 'src':
+                        filename = value
+                    if key == 'height':
+                        wh.append(img_height2latex(value))
+                    if key == 'width':
+                        wh.append(img_width2latex(value))
+                output.append(r'\includegraphics')
+                if len(wh) > 0:
+                    output.append('[' + ', '.join(wh) + ']')
+                output.append('{' + filename + '}')
+            elif tag == 'hr':
+                output.append('\n' + r'\par\noindent\rule{\textwidth}{0.4pt}' + '\n')
+            elif tag == 'b':
+                output.append(r'{\bf ')
+            elif tag == 'i':
+                output.append(r'{\it ')
+            elif tag == 'em':
+                output.append(r'{\em ')
+            elif tag == 'u':
+                output.append(r'\underline{')
+            elif tag == 'tt':
+                output.append(r'\texttt{')
+            elif tag == 'br':
+                output.append('\n\n')
+            elif tag == 'p':
+                output.append('\n')
+            elif tag == 'h1':
+                output.append(r'{\Large\bf ')
+            elif tag == 'h2':
+                output.append(r'{\large\bf ')
+            elif tag == 'h3':
+                output.append(r'{\bf\it ')
+            elif tag == 'h4':
+                output.append(r'{\bf ')
+            elif tag == 'ul':
+                output.append(r'\begin{itemize}'+'\n')
+            elif tag == 'ol':
+                output.append(r'\begin{enumerate}'+'\n')
+            elif tag == 'li':
+                output.append(r'\item ')
+            elif tag == 'a':
+                for key, value in attrs:
+                    if key == 'href':
+                        target = value
+                output.append(r'\href{'+target+'}{')
+            elif tag in ignored_tags:
+                pass   # we ignore these tags, since we don't want to typeset them
+            else:      # a tag we don't know about, it might be math and not a tag at all, so let's do something with it
+                unknown_tag = self.get_starttag_text()
+                output.append('<'+html2latex_old(unknown_tag[1:]))  # if a valid tag closed this, then we want it processed!
+                if verbose:
+                    print(f'opening tag <{tag}> ignored. Exact text:')
+                    print('  "'+unknown_tag+'"')
+
+
+
+        def handle_endtag(self, tag):
+            if tag in ['b', 'i', 'u', 'a', 'em','tt']:
+                output.append('} ')
+            elif tag in ['h1', 'h2', 'h3', 'h4']:
+                output.append('}\n')
+            elif tag in ['p', 'li']:
+                output.append('\n')
+            elif tag == 'ul':
+                output.append(r'\end{itemize}'+'\n')
+            elif tag == 'ol':
+                output.append(r'\end{enumerate}'+'\n')
+            elif tag in ignored_tags:
+                pass   # we ignore these tags, since we don't want to typeset them
+            else:
+                output.append('</'+tag+'> ')   # some unknown tag, perhaps part of an equation...
+                if verbose:
+                    print(f'closing tag </{tag}> ignored.')
+
+        def handle_data(self, data):
+            output.append(data)
+
+    parser = myparser()
+    parser.feed(text)
+    return ''.join(output)
+
+def make_texts(n=2000):
+    '''Returns n question texts like those of a pool of variants: a shared stem with some math in it.'''
+    stem = (r'<p>Let \(f(x) = x^2\) on \(0<x<{a}\). Which of the following is true for all \(y>{b}\)?</p>'
+            r'<img src="images/plot{a}.png" width="50%"><br><b>Hint:</b> \(f(x)<f(y)\) if \(x<y\).')
+    math = ''.join(fr' \(a_{{{k}}}<a_{{{k+1}}}\)' for k in range(20))
+    return [stem.format(a=k % 50, b=k % 7)+'<p>'+math+'</p>' for k in range(n)]
+
+if __name__ == '__main__':
+    texts = make_texts()
+    assert [html2latex(s) for s in texts] == [html2latex_old(s) for s in texts]
+    parser = Html2LatexParser()
+    for name, convert in [('old', lambda texts: [html2latex_old(s) for s in texts]),
+                          ('new, uncached', lambda texts: [parser.convert(s) for s in texts]),
+                          ('new', lambda texts: [html2latex(s) for s in texts]),
+                          ('convert_many', convert_many)]:
+        t = min(timeit.repeat(lambda: convert(texts), setup=html2latex_cache.clear, number=1, repeat=5))
+        print(f'{name:>14}: {1e6*t/len(texts):8.1f} microseconds per text')
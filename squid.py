@@ -3,7 +3,8 @@
 #
 # To do: (I hope I remember to keep this as my main todo list)
 #
-# * Update html2latex to handle tables (medium), images in urls (low)
+# * Update html2latex to handle images in urls (low)
+#     (done: tables)
 #   * For this I must learn more html and css...
 # * Fix Question_MCQ to correctly handle variable numbers of answers (high)
 # * Write some nice Python Squid demos/tutorials (high), also for e.g. Physics
@@ -11,38 +12,92 @@
 # * Figure out how to manage lots of question pools and save them to disk (medium)
 # * Include marking rubrics in QTI files (medium)
 # * nicen up the selection_wizard with better tooltips etc. (medium)
-# * Implement more question types: computed answer (medium),
-#     multiple selections (low), match answer (low), explore others (low)
+# * Implement more question types: explore others (low)
+#     (done: numerical, multiple answers, matching, fill in multiple blanks)
 # * Write better docsrtings (medium) with tests (low)
 # * Wrap code to 79 columns (low)
 #
 # * Squid Ink: paper-based quizzes! (???)
+#     (started: squid_ink.py makes personalised exams and answer keys)
 
 import os
+import sys
 import pickle
 import itertools
 import random
 import re
-from zipfile import ZipFile
+import json
+import sqlite3
+import hashlib
+import traceback
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections.abc import Sequence
+from copy import copy
+from contextlib import contextmanager
+from io import TextIOWrapper
+from shutil import copyfileobj
+from zipfile import ZipFile, ZIP_DEFLATED
 import ipywidgets as widgets
 from IPython.display import FileLink, display, HTML
-from squid_utils import (html2latex, get_img_filenames, get_filepaths,
-    get_subdirs, destroy)
-from squid_qti import (qti_text, ET_file_upload_question, ET_MCQ, SaveToQtiFile)
+from squid_utils import (html2latex, convert_many, get_img_filenames, get_question_img_filenames, get_filepaths,
+    get_subdirs, destroy, MediaRegistry, json_default, json_object_hook, id_generator)
+from squid_qti import (qti_text, ET_file_upload_question, ET_MCQ, ET_numerical_question, ET_multiple_answers_question,
+    ET_matching_question, ET_fill_in_multiple_blanks_question, SaveToQtiFile, SaveQuizzesToQtiFile, ReadQtiFile)
 from textwrap import dedent
+from types import MemberDescriptorType
 
 # Basic question types:
+#
+# The question classes use __slots__ for the attributes most questions set, so that the hundreds of thousands of
+# variants of a big pool take less memory. They still have a __dict__ (only created when needed), so any other
+# attribute can be set on a question as before. The question_type is the same for all questions of a class, so it is
+# a class attribute. A slot hides the default in Question_Base of the same name (variant_number, table_row, ...),
+# so Question_Base.__getattr__ falls back to the class default when a slot isn't set: for questions without a
+# table_row, old pickles, or subclasses whose __init__ doesn't call super().__init__().
+# Defaults shared by all questions must be immutable (tuples, str).
+
+unset_slot = object()  # marks a name missing from a class __dict__ in Question_Base.__getattr__
+
+written_rubric = dedent(
+        r"""\noindent{\bf Marking Scheme:}
+            \begin{small}
+            \begin{itemize}
+            \item 1 mark: The student demonstrates a partial understanding of how to do the problem.
+            \item 2 marks: The student demonstrates a good understanding of how to do the problem \\ (some minor errors permitted).
+            \item 3 marks: The student demonstrates a good understanding and obtains the correct answer.
+            \end{itemize}
+            \end{small}""")  # the default rubric of Question_Written, dedented once and shared by all questions
 
 class Question_Base(object):
     '''Base class for questions. Contains methods and attributes common to all question types.
     Specific question types, such as Question_MCQ and Question_Written will be subclasses of this. '''
+    __slots__ = ('__dict__', '__weakref__')
     points = 0
     variant_number = 0
     question_text = "there is no question text yet"
     question_text_basic = "there is no question text yet"
     solution_text = "no solution to no question"
-    table_row = []
-    table_header = []
+    table_row = ()     # tuples, not lists: a class attribute is shared by all questions, so mustn't be changed in place
+    table_header = ()
+
+    def __getattr__(self, name):
+        '''Only called for attributes that aren't set: returns the class default hidden by a slot of the same name.'''
+        for cls in type(self).__mro__:
+            value = cls.__dict__.get(name, unset_slot)
+            if value is not unset_slot and not isinstance(value, MemberDescriptorType):
+                return value
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def __setstate__(self, state):
+        '''Restores a pickled question, including ones pickled before the question classes had __slots__.'''
+        if isinstance(state, tuple):  # (__dict__, slots), as pickled by object.__getstate__
+            state = {**(state[0] or {}), **(state[1] or {})}
+        for key, value in state.items():
+            if key in ('question_type', 'rubric') and value == getattr(type(self), key, None):
+                continue  # keep the class default, rather than a copy per question
+            setattr(self, key, value)
 
     def q_text(self): # these can be rewritten when defining new questions
         return self.question_text
@@ -62,6 +117,20 @@ class Question_Base(object):
         '''Returns self.question_text converted from html to latex.'''
         return(html2latex(self.q_text()))
 
+    def answer_texts(self):
+        '''Returns a list of the texts of all answers offered (for finding images etc.)'''
+        return []
+
+    def add_image(self, filename, **attributes):
+        '''
+        Registers the image file filename as used by this question and returns an html img tag for it, e.g.
+        Q.question_text = Q.add_image(path, width="50%")+'<br>Classify the critical point...'
+        Once a question has registered images, get_question_img_filenames returns these instead of
+        searching its html, so register all of its images (or none).
+        '''
+        self.images = list(getattr(self, 'images', ()))+[filename]
+        return '<img src="'+filename+'"'+''.join(f' {key}="{value}"' for key, value in attributes.items())+'>'
+
     def _repr_html_(self):
         return(self.q_text())
 
@@ -83,21 +152,15 @@ class Question_Written(Question_Base):
 
     Various methods display this data, save the marking scheme to a .tex file, etc.
     '''
+    question_type = 'WAQ'
+    rubric = written_rubric  # set self.rubric for a different marking scheme
+    __slots__ = ('question_text', 'solution_text', 'marks', 'variant_number', 'table_row', 'table_header')
+
     def __init__(self, question_text='No question yet.', solution_text='No solution yet.', marks=3, variant_number=0):
-        self.question_type = 'WAQ'
         self.question_text = question_text
         self.solution_text = solution_text
         self.marks = marks
         self.variant_number = variant_number
-        self.rubric = dedent(
-        r"""\noindent{\bf Marking Scheme:}
-            \begin{small}
-            \begin{itemize}
-            \item 1 mark: The student demonstrates a partial understanding of how to do the problem.
-            \item 2 marks: The student demonstrates a good understanding of how to do the problem \\ (some minor errors permitted).
-            \item 3 marks: The student demonstrates a good understanding and obtains the correct answer.
-            \end{itemize}
-            \end{small}""")
 
     def q_text(self, show_variant_number=True, variant_number=0, show_marks=False): # these can be rewritten when defining new questions
         if variant_number != 0:
@@ -202,14 +265,17 @@ class Question_MCQ(Question_Base):
 
 
     """
-    def __init__(self, question_text='No text yet', answer='', wrong_answers=[], marks=1, variant_number=0):
-        self.question_type = 'MCQ'
+    question_type = 'MCQ'
+    __slots__ = ('question_text', 'answer', 'wrong_answers', 'marks', 'variant_number',
+                 'answer_shuffle', 'answer_index', 'shuffle_seed', 'table_row', 'table_header')
+
+    def __init__(self, question_text='No text yet', answer='', wrong_answers=None, marks=1, variant_number=0):
         self.question_text = question_text
         self.answer = answer
-        self.wrong_answers = wrong_answers
+        self.wrong_answers = [] if wrong_answers is None else wrong_answers
         self.marks = marks
         self.variant_number = variant_number
-        self.answer_shuffle = [0,1,2,3]
+        self.answer_shuffle = (0,1,2,3)  # shared until shuffle() makes a new list
         self.answer_index = 0
         self.shuffle_seed = 0
 
@@ -262,11 +328,12 @@ class Question_MCQ(Question_Base):
         '''Shuffles the four answers, using the random seed self.shuffle_seed, which can be set by the optional parameter s.'''
         if s!=0:
             self.shuffle_seed = s
-            random.seed(s)
+            rng = random.Random(s)  # same order as random.seed(s), but leaves the global generator alone
         else:
             self.shuffle_seed = 0
+            rng = random
         self.answer_shuffle = [0,1,2,3]
-        random.shuffle(self.answer_shuffle)
+        rng.shuffle(self.answer_shuffle)
         # random.seed()  # reset the random number generator!
         self.answer_index = self.answer_shuffle.index(0)
         # i=1
@@ -287,194 +354,1239 @@ class Question_MCQ(Question_Base):
         answers = [self.answer]+self.wrong_answers
         return len(answers)==len(set(answers))
 
+    def answer_texts(self):
+        '''Returns a list of the texts of all answers offered (for finding images etc.)'''
+        return [self.answer]+self.wrong_answers
+
     def _repr_html_(self):
         s=self.q_text()+r"<br><ol>"+\
         "\n".join([r"<li>"+a+r"</li>" for a in [self.answer]+self.wrong_answers+["None of these"]])+\
         r"</ol>"
         return(s)
 
+def BB_text(s):
+    """Reformats the string s for a Blackboard upload file: formulas are escaped to play nicely with MathJax,
+    and newlines replaced with spaces. (As in Bjoern Rueffer's make_BB_row code.)"""
+    s = re.sub(r'\$\$(.*?)\$\$',r'\\[\1\\]',s)
+    s = re.sub(r'\$(.*?)\$',r'\\(\1\\)',s)
+    s = re.sub(r'\\dfrac\b',r'\\frac',s)
+    return re.sub('[\n ]+',' ',s)
+
+class Question_Numerical(Question_Base):
+    """
+    This class defines a question with a numerical answer, e.g. a computed answer.
+
+    ATTRIBUTES:
+        points : int
+        answer : a number (anything float() understands, e.g. a Sage number)
+        tolerance : responses within tolerance of answer are marked correct
+        question_text : str
+    """
+    question_type = 'NUM'
+    __slots__ = ('question_text', 'answer', 'tolerance', 'marks', 'variant_number',
+                 'table_row', 'table_header')
+
+    def __init__(self, question_text='No text yet', answer=0, tolerance=0, marks=1, variant_number=0):
+        self.question_text = question_text
+        self.answer = answer
+        self.tolerance = tolerance
+        self.marks = marks
+        self.variant_number = variant_number
+
+    def qti(self, variant_number=None, points=1, title=None):
+        '''Return and ElementTree element representing this question, ready for inserting into a QTI assessment.
+        if variant_number is None, the question's own variant number is used.'''
+        if variant_number is not None:
+            self.variant_number = variant_number
+        if title is None:
+            title = f'Question {self.variant_number}'
+        return ET_numerical_question(text=qti_text(self.q_text()), points=points, title=title,
+            answer=self.answer, tolerance=self.tolerance)
+
+    def make_BB_row(self):
+        '''Converts the question into a tuple of the format (NUM, question, answer, tolerance) for Blackboard.'''
+        return ('NUM', BB_text(self.q_text()), str(float(self.answer)), str(float(self.tolerance)))
+
+    def write_BB_row(self, f):  #f is a file that's already been opened for writing
+        '''Writes the question in one line to file f (assumed to be open and writable) in the correct format for BlackBoard'''
+        f.write("\t".join(self.make_BB_row())+"\n")
+
+    def latex_sorted(self):
+        '''Returns LaTex code that typsets the question and its answer.'''
+        s = html2latex(self.q_text())+"\n\n\\noindent{\\bf Answer:} $%s$"%self.answer
+        if self.tolerance != 0:
+            s += " $\\pm %s$"%self.tolerance
+        return s
+
+    def answer_texts(self):
+        '''Returns a list of the texts of all answers offered (here the answer and tolerance).'''
+        return [str(self.answer), str(self.tolerance)]
+
+    def _repr_html_(self):
+        s = self.q_text()+"<br><b>Answer:</b> $%s$"%self.answer
+        if self.tolerance != 0:
+            s += " $\\pm %s$"%self.tolerance
+        return s
+
+class Question_MultipleAnswer(Question_Base):
+    """
+    This class defines a multiple answer question: the student has to select all correct answers,
+    and none of the wrong ones.
+
+    ATTRIBUTES:
+        points : int
+        answers : List of str, the correct answers
+        wrong_answers : List of str
+        question_text : str
+    """
+    question_type = 'MA'
+    __slots__ = ('question_text', 'answers', 'wrong_answers', 'marks', 'variant_number',
+                 'table_row', 'table_header')
+
+    def __init__(self, question_text='No text yet', answers=None, wrong_answers=None, marks=1, variant_number=0):
+        self.question_text = question_text
+        self.answers = [] if answers is None else answers
+        self.wrong_answers = [] if wrong_answers is None else wrong_answers
+        self.marks = marks
+        self.variant_number = variant_number
+
+    def qti(self, variant_number=None, points=1, title=None):
+        '''Return and ElementTree element representing this question, ready for inserting into a QTI assessment.
+        if variant_number is None, the question's own variant number is used.'''
+        if variant_number is not None:
+            self.variant_number = variant_number
+        if title is None:
+            title = f'Question {self.variant_number}'
+        return ET_multiple_answers_question(text=qti_text(self.q_text()), points=points, title=title,
+            answers=[qti_text(m) for m in self.answers], wrong_answers=[qti_text(m) for m in self.wrong_answers])
+
+    def make_BB_row(self):
+        '''Converts the question and answers into a tuple of the format
+        (MA, question, random_answer1, "correct/incorrect", random_answer2, "correct/incorrect", ...)
+        for Blackboard. The answers are shuffled differently in each invocation of this function.'''
+        answers = [(BB_text(a), 'correct') for a in self.answers]+[(BB_text(a), 'incorrect') for a in self.wrong_answers]
+        random.shuffle(answers)
+        return ('MA', BB_text(self.q_text()), *itertools.chain(*answers))
+
+    def write_BB_row(self, f):  #f is a file that's already been opened for writing
+        '''Writes the question in one line to file f (assumed to be open and writable) in the correct format for BlackBoard'''
+        f.write("\t".join(self.make_BB_row())+"\n")
+
+    def latex_sorted(self):
+        '''Returns LaTex code that typsets the question and answers. Correct answers are listed first, and ticked.'''
+        items = ["  \\item[$\\checkmark$] %s \n"%a for a in self.answers]+\
+                ["  \\item[$\\times$] %s \n"%a for a in self.wrong_answers]
+        return html2latex(self.q_text())+"\n\\begin{itemize}\n"+"".join(items)+"\\end{itemize}"
+
+    def has_distinct_answers(self):
+        '''Returns true if all answers are distinct.'''
+        answers = self.answers+self.wrong_answers
+        return len(answers)==len(set(answers))
+
+    def answer_texts(self):
+        '''Returns a list of the texts of all answers offered (for finding images etc.)'''
+        return self.answers+self.wrong_answers
+
+    def _repr_html_(self):
+        return self.q_text()+r"<br><ul>"+\
+        "\n".join([r"<li>"+a+r" (correct)</li>" for a in self.answers]+[r"<li>"+a+r"</li>" for a in self.wrong_answers])+\
+        r"</ul>"
+
+class Question_Matching(Question_Base):
+    """
+    This class defines a matching question.
+
+    ATTRIBUTES:
+        points : int
+        pairs : List of pairs (left, right) of str: the student has to match each left with its right
+        distractors : List of str, extra options to choose from which don't match anything
+        question_text : str
+    """
+    question_type = 'MAT'
+    __slots__ = ('question_text', 'pairs', 'distractors', 'marks', 'variant_number',
+                 'table_row', 'table_header')
+
+    def __init__(self, question_text='No text yet', pairs=None, distractors=None, marks=1, variant_number=0):
+        self.question_text = question_text
+        self.pairs = [] if pairs is None else pairs
+        self.distractors = [] if distractors is None else distractors
+        self.marks = marks
+        self.variant_number = variant_number
+
+    def qti(self, variant_number=None, points=1, title=None):
+        '''Return and ElementTree element representing this question, ready for inserting into a QTI assessment.
+        if variant_number is None, the question's own variant number is used.'''
+        if variant_number is not None:
+            self.variant_number = variant_number
+        if title is None:
+            title = f'Question {self.variant_number}'
+        return ET_matching_question(text=qti_text(self.q_text()), points=points, title=title,
+            pairs=[(qti_text(left), qti_text(right)) for left, right in self.pairs],
+            distractors=[qti_text(m) for m in self.distractors])
+
+    def make_BB_row(self):
+        '''Converts the question into a tuple of the format (MAT, question, left1, right1, left2, right2, ...)
+        for Blackboard. Blackboard doesn't do distractors, so these are left out.'''
+        return ('MAT', BB_text(self.q_text()), *itertools.chain(*[(BB_text(l), BB_text(r)) for l, r in self.pairs]))
+
+    def write_BB_row(self, f):  #f is a file that's already been opened for writing
+        '''Writes the question in one line to file f (assumed to be open and writable) in the correct format for BlackBoard'''
+        f.write("\t".join(self.make_BB_row())+"\n")
+
+    def latex_sorted(self):
+        '''Returns LaTex code that typsets the question and the correct matches.'''
+        s = html2latex(self.q_text())+"\n\\begin{enumerate}\n"+\
+            "".join(["  \\item %s $\\longrightarrow$ %s \n"%(l, r) for l, r in self.pairs])+"\\end{enumerate}"
+        if len(self.distractors) > 0:
+            s += "\nDistractors: "+", ".join(self.distractors)
+        return s
+
+    def answer_texts(self):
+        '''Returns a list of the texts of all answers offered (for finding images etc.)'''
+        return [l for l, r in self.pairs]+[r for l, r in self.pairs]+self.distractors
+
+    def _repr_html_(self):
+        s = self.q_text()+r"<br><ol>"+"\n".join([r"<li>"+l+r" &rarr; "+r+r"</li>" for l, r in self.pairs])+r"</ol>"
+        if len(self.distractors) > 0:
+            s += "Distractors: "+", ".join(self.distractors)
+        return s
+
+class Question_FillInBlanks(Question_Base):
+    """
+    This class defines a fill-in-multiple-blanks question.
+
+    ATTRIBUTES:
+        points : int
+        question_text : str, in which each blank appears as [name]
+        blanks : dict mapping the name of each blank to the list of answers accepted for it (or a single answer)
+    """
+    question_type = 'FIB'
+    __slots__ = ('question_text', 'blanks', 'marks', 'variant_number', 'table_row',
+                 'table_header')
+
+    def __init__(self, question_text='No text yet', blanks=None, marks=1, variant_number=0):
+        self.question_text = question_text
+        self.blanks = {} if blanks is None else blanks
+        self.marks = marks
+        self.variant_number = variant_number
+
+    def accepted(self, name):
+        '''Returns the list of answers accepted for the blank called name.'''
+        answers = self.blanks[name]
+        return [answers] if isinstance(answers, str) else list(answers)
+
+    def qti(self, variant_number=None, points=1, title=None):
+        '''Return and ElementTree element representing this question, ready for inserting into a QTI assessment.
+        if variant_number is None, the question's own variant number is used.'''
+        if variant_number is not None:
+            self.variant_number = variant_number
+        if title is None:
+            title = f'Question {self.variant_number}'
+        return ET_fill_in_multiple_blanks_question(text=qti_text(self.q_text()), points=points, title=title,
+            blanks={name: [qti_text(a) for a in self.accepted(name)] for name in self.blanks})
+
+    def make_BB_row(self):
+        '''Converts the question into a tuple of the format
+        (FIB_PLUS, question, name1, answer1, answer2, ..., "", name2, answer3, ...) for Blackboard.'''
+        row = ['FIB_PLUS', BB_text(self.q_text())]
+        for name in self.blanks:
+            row = row+[name]+[BB_text(a) for a in self.accepted(name)]+['']
+        return tuple(row[:-1])
+
+    def write_BB_row(self, f):  #f is a file that's already been opened for writing
+        '''Writes the question in one line to file f (assumed to be open and writable) in the correct format for BlackBoard'''
+        f.write("\t".join(self.make_BB_row())+"\n")
+
+    def latex_sorted(self):
+        '''Returns LaTex code that typsets the question and the accepted answers for each blank.'''
+        return html2latex(self.q_text())+"\n\\begin{itemize}\n"+\
+            "".join(["  \\item[{[%s]}] %s \n"%(name, " \\quad or \\quad ".join(self.accepted(name))) for name in self.blanks])+\
+            "\\end{itemize}"
+
+    def answer_texts(self):
+        '''Returns a list of the texts of all answers offered (for finding images etc.)'''
+        return [a for name in self.blanks for a in self.accepted(name)]
+
+    def _repr_html_(self):
+        return self.q_text()+r"<br><ul>"+\
+        "\n".join([r"<li>["+name+"]: "+" or ".join(self.accepted(name))+r"</li>" for name in self.blanks])+r"</ul>"
+
+template_globals = {'__builtins__': __builtins__}  # the names (besides the parameters) usable in templates
+
+def template_source(value, k):
+    '''
+    Returns Python source for the VariantFamily field value, number k in the list _v of all field values:
+    a template string becomes an f-string (so {a+b} and {x:.2f} work, and literal braces, as in LaTeX, are
+    written {{ }}), a list or tuple of them a list of f-strings, a function of the parameters a call of it
+    with the dict _p of the parameters, and anything else a copy of the value itself.
+    '''
+    if isinstance(value, str):
+        return 'f'+repr(value)
+    if isinstance(value, (list, tuple)) and all(isinstance(v, str) for v in value):
+        return '['+', '.join('f'+repr(v) for v in value)+']'
+    if callable(value):
+        return f'_v[{k}](**_p)'
+    return f'_copy(_v[{k}])'
+
+def compile_variant_maker(question_class, templates, names, namespace=None):
+    '''
+    Compiles the templates (a dict mapping attributes to VariantFamily field values) for the parameter names
+    into a function make(variant_number, *parameters), which returns a new question_class question
+    with its attributes rendered for the parameters (given by position or by name). The templates can also use
+    the names in template_globals and in the dict namespace.
+    This way the templates are parsed once for the whole family, and making a variant is about as fast as
+    the hand-written loop of f-strings it replaces.
+    '''
+    values = list(templates.values())
+    lines = [f'def make(_n, {", ".join(names)}):', '    Q = _cls()']
+    if any(callable(v) for v in values):
+        lines.append(f'    _p = {{{", ".join(f"{name!r}: {name}" for name in names)}}}')
+    lines += [f'    Q.{key} = {template_source(v, k)}' for k, (key, v) in enumerate(templates.items())]
+    lines += ['    Q.variant_number = _n', '    return Q']
+    namespace = {**template_globals, **(namespace or {}), '_cls': question_class, '_v': values, '_copy': copy}
+    exec(compile('\n'.join(lines), '<VariantFamily templates>', 'exec'), namespace)
+    return namespace['make']
+
+class VariantFamily(object):
+    '''
+    A family of variants of a question, defined by templates instead of loops. For example
+
+        F = VariantFamily(Question_MCQ, {'a': range(1, 4), 'b': range(1, 4)},
+                          question_text=r'Compute \\({a}+{b}\\).', answer=r'\\({a+b}\\)',
+                          wrong_answers=[r'\\({a+b+1}\\)', r'\\({a+b+2}\\)', r'\\({a+b-1}\\)'],
+                          table_header=['a', 'b'], table_row=['{a}', '{b}'],
+                          constraints=[Question_MCQ.has_distinct_answers])
+        L = list(F)
+
+    makes the 9 questions of the tutorial's first example. Variants are made lazily, one at a time, as the family is
+    iterated over, so a huge family can be fed straight to e.g. save_pool or SaveToQtiFile.
+
+    question_class : the class of the questions, e.g. Question_MCQ or Question_Written (or a subclass)
+    grid : dict mapping parameter names to lists of values: all combinations are used, in order.
+           Or any iterable of dicts of parameters.
+    sampler : instead of grid, a function that takes a random.Random and returns a dict of parameters;
+              n variants are then made. With a dict grid and n, a random sample of n combinations is used.
+    seed : the seed for sampler or sampling (default None: different every time)
+    where : a function of the parameters (as keyword arguments); parameters for which it is False are skipped
+    constraints : list of functions of the question (such as Question_MCQ.has_distinct_answers); variants
+                  for which one of them is False are skipped
+    first_variant : the variant number of the first variant, the others are numbered consecutively
+    namespace : dict of further names the templates can use, e.g. {'Fraction': Fraction} for '{Fraction(a, b)}'
+    templates : the attributes of the questions: a template (see template_source) or list of templates, or a
+                function taking the parameters as keyword arguments, e.g. solution_text=lambda a, b: ...
+    '''
+    def __init__(self, question_class, grid=None, sampler=None, n=None, seed=None, where=None, constraints=(),
+                 first_variant=1, namespace=None, **templates):
+        self.question_class = question_class
+        self.grid = grid
+        self.sampler = sampler
+        self.n = n
+        self.seed = seed
+        self.where = where
+        self.constraints = list(constraints)
+        self.first_variant = first_variant
+        self.namespace = namespace
+        self.templates = templates
+        self.makers = {}  # tuple of parameter names -> compiled function making the variants (see compile_variant_maker)
+
+    def maker(self, names):
+        '''Returns the function making variants from the parameters names (see compile_variant_maker).'''
+        names = tuple(names)
+        if names not in self.makers:
+            self.makers[names] = compile_variant_maker(self.question_class, self.templates, names, self.namespace)
+        return self.makers[names]
+
+    def combinations(self):
+        '''Yields the tuples of values of a dict grid, in order or sampled (see the class docstring).'''
+        values = [list(v) for v in self.grid.values()]
+        if self.n is None:
+            yield from itertools.product(*values)
+            return
+        total = 1
+        for v in values:
+            total *= len(v)
+        for index in random.Random(self.seed).sample(range(total), min(self.n, total)):
+            combination = []   # decode the index, rather than listing all combinations
+            for v in reversed(values):
+                index, k = divmod(index, len(v))
+                combination.append(v[k])
+            yield tuple(reversed(combination))
+
+    def params(self):
+        '''Yields the dicts of parameters of the variants (before applying where).'''
+        if self.sampler is not None:
+            rng = random.Random(self.seed)
+            for k in range(self.n):
+                yield self.sampler(rng)
+        elif isinstance(self.grid, dict):
+            names = list(self.grid)
+            for combination in self.combinations():
+                yield dict(zip(names, combination))
+        else:
+            yield from self.grid
+
+    def make(self, params, variant_number=0):
+        '''Returns the question for the dict params, with the given variant number.'''
+        return self.maker(params)(variant_number, **params)
+
+    def __iter__(self):
+        variant_number = self.first_variant
+        if self.sampler is None and isinstance(self.grid, dict):  # fast path: parameters by position
+            names = list(self.grid)
+            make = self.maker(names)
+            for combination in self.combinations():
+                if self.where is not None and not self.where(**dict(zip(names, combination))):
+                    continue
+                Q = make(variant_number, *combination)
+                if all(check(Q) for check in self.constraints):
+                    yield Q
+                    variant_number += 1
+            return
+        for params in self.params():
+            if self.where is not None and not self.where(**params):
+                continue
+            Q = self.make(params, variant_number)
+            if all(check(Q) for check in self.constraints):
+                yield Q
+                variant_number += 1
+
+def seed_variant(seed, index):
+    '''
+    Seeds the random number generators for making variant number index (counting from 0) of a pool with the given
+    seed: Python's random module, and numpy's and Sage's if they are loaded. So each variant gets its own random
+    numbers, which don't depend on which process makes it, or on the other variants.
+    '''
+    random.seed(f'{seed}:{index}')
+    n = int.from_bytes(hashlib.blake2b(f'{seed}:{index}'.encode(), digest_size=4).digest(), 'big')
+    if 'numpy' in sys.modules:
+        sys.modules['numpy'].random.seed(n)
+    if 'sage.all' in sys.modules:
+        sys.modules['sage.all'].set_random_seed(n)
+
+@contextmanager
+def preserved_random_state():
+    '''
+    Context manager: on leaving, restores the random number generators that seed_variant seeds (Python's random
+    module, and numpy's and Sage's) to their state on entering, so seeding variants in this process doesn't change
+    the random numbers drawn afterwards. Generators only loaded inside the with-block are seeded randomly instead.
+    '''
+    state = random.getstate()
+    numpy = sys.modules.get('numpy')
+    numpy_state = numpy.random.get_state() if numpy is not None else None
+    sage = sys.modules.get('sage.all')
+    sage_seed = sage.seed() if sage is not None else None  # restores Sage's previous random state on __exit__
+    if sage_seed is not None:
+        sage_seed.__enter__()
+    try:
+        yield
+    finally:
+        if sage_seed is not None:
+            sage_seed.__exit__(None, None, None)
+        elif 'sage.all' in sys.modules:
+            sys.modules['sage.all'].set_random_seed()
+        if numpy_state is not None:
+            numpy.random.set_state(numpy_state)
+        elif 'numpy' in sys.modules:
+            sys.modules['numpy'].random.seed()
+        random.setstate(state)
+
+def _generate_variant(job):
+    '''Makes a single variant in generate_variants, possibly in a worker process. job is (func, params, seed, index).
+    Returns (index, question, None), or (index, None, error message) if func raised an exception.'''
+    func, params, seed, index = job
+    seed_variant(seed, index)
+    try:
+        Q = func(**params) if isinstance(params, dict) else func(*params)
+    except Exception:
+        return index, None, traceback.format_exc(limit=-1).strip()
+    return index, Q, None
+
+def generate_variants(func, param_grid, workers=None, seed=None, chunksize=1, make_variant_numbers=True,
+                      verbose=True):
+    '''
+    Makes the variants Q = func(**params) for the parameters in param_grid, in a pool of worker processes, so that
+    slow variants (calling Sage, or drawing plots with matplotlib) are made in parallel. For example
+
+        L, failures = generate_variants(identify_crit_MCQ, {'a': [-1, 2], 'b': [-1, 2], 's1': [1, -1], 's2': [1, -1]},
+                                        workers=4, seed=2022)
+
+    param_grid : dict mapping parameter names to lists of values (all combinations are used, in order), or any
+                 iterable of dicts (used as keyword arguments) or tuples (used as positional arguments).
+    workers : the number of processes; if None (default) the variants are made one by one in this process
+              (which leaves the random number generators of this process as they were, see preserved_random_state).
+    seed : before each variant is made, the random number generators are seeded from seed and its position in the
+           grid (see seed_variant), so the results are the same for any number of workers. If None, a random seed.
+    chunksize : the number of variants each worker is given at a time.
+    make_variant_numbers : if True (default), the variants made are numbered 1, 2, 3, ...
+    verbose : if True (default), print each failure.
+
+    Returns (L, failures): L is the list of questions, in the order of param_grid, and failures is a list of
+    (params, traceback) for the parameters where func raised an exception; these are left out of L.
+    With workers, func (and the questions it returns) must be picklable: define func at the top level of a module
+    or notebook (the workers can find notebook functions on Linux, where they are forked from the notebook).
+    '''
+    if seed is None:
+        seed = id_generator(16)
+    if isinstance(param_grid, dict):
+        names = list(param_grid)
+        param_grid = (dict(zip(names, values)) for values in itertools.product(*param_grid.values()))
+    grid = list(param_grid)
+    jobs = ((func, params, seed, index) for index, params in enumerate(grid))
+    if workers is None:
+        with preserved_random_state():
+            L, failures = collect_variants(grid, map(_generate_variant, jobs), make_variant_numbers, verbose)
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            L, failures = collect_variants(grid, pool.imap(_generate_variant, jobs, chunksize), make_variant_numbers,
+                                           verbose)
+    return L, failures
+
+def collect_variants(grid, results, make_variant_numbers=True, verbose=True):
+    '''Sorts the results of _generate_variant for the parameters in grid into (questions, failures), see generate_variants.'''
+    L, failures = [], []
+    for index, Q, error in results:
+        if error is None:
+            if make_variant_numbers:
+                Q.variant_number = len(L)+1
+            L.append(Q)
+        else:
+            failures.append((grid[index], error))
+            if verbose:
+                print(f'Variant with parameters {grid[index]} failed: {error.splitlines()[-1]}')
+    return L, failures
+
+def question_attributes(Q):
+    '''Returns the names of the attributes set on the question Q, whether they are kept in __slots__ or in __dict__.'''
+    names = [key for cls in reversed(type(Q).__mro__) for key in cls.__dict__.get('__slots__', ())
+             if key not in ('__dict__', '__weakref__') and hasattr(Q, key)]
+    return list(dict.fromkeys(names+list(vars(Q))))
+
+def compact_pool(pool):
+    '''
+    Reduces the memory used by the questions in pool (a list, say of 100k generated variants) by making them share
+    equal data: every str attribute, and every str in a list, tuple or dict attribute, is replaced by a single shared
+    copy, and equal table_header/table_row lists become one shared tuple. The questions are changed in place
+    and pool is returned, so one can write L = compact_pool([make_question(a) for a in range(100000)]).
+    '''
+    shared = {}
+    def share(x):
+        return shared.setdefault(x, x)
+    for Q in pool:
+        for key in question_attributes(Q):
+            value = getattr(Q, key)
+            if isinstance(value, str):
+                value = share(value)
+            elif key in ('table_header', 'table_row') and isinstance(value, (list, tuple)):
+                value = share(tuple(share(s) if isinstance(s, str) else s for s in value))
+            elif isinstance(value, list):
+                value[:] = [share(s) if isinstance(s, str) else s for s in value]
+                continue
+            elif isinstance(value, tuple):
+                value = tuple(share(s) if isinstance(s, str) else s for s in value)
+            elif isinstance(value, dict):
+                for k, v in value.items():
+                    if isinstance(v, str):
+                        value[k] = share(v)
+                continue
+            else:
+                continue
+            setattr(Q, key, value)
+    return pool
+
 # Next: Pool handling: save, load, displat etc question pools??
 
+def qti2squid(d):
+    '''
+    Turns a dict d describing a QTI question (as produced by ReadQtiFile) into a Squid question,
+    or returns None if Squid doesn't support its question type.
+    Essay and file upload questions become Question_Written; their solution isn't in the QTI file.
+    '''
+    marks = int(d['points']) if d.get('points', 1) == int(d.get('points', 1)) else d['points']
+    question_type = d['question_type']
+    if question_type in ('essay_question', 'file_upload_question'):
+        Q = Question_Written(marks=marks)
+        m = re.search(r'<br>\[For office use only: V(\d+)\]$', d['text'])
+        if m:  # made by Squid: strip the variant number, it gets added again
+            Q.variant_number = int(m.group(1))
+        Q.question_text = d['text'][:m.start()] if m else d['text']
+        Q.solution_text = 'Sorry, solution not provided in QTI files.'
+    elif question_type == 'multiple_choice_question':
+        Q = Question_MCQ(question_text=d['text'], answer=d['answer'], marks=marks,
+            wrong_answers=[a for a in d['wrong_answers'] if a != 'None of the others'])  # Squid adds this itself
+    elif question_type == 'multiple_answers_question':
+        Q = Question_MultipleAnswer(question_text=d['text'], answers=d['answers'], wrong_answers=d['wrong_answers'],
+                                    marks=marks)
+    elif question_type == 'numerical_question':
+        Q = Question_Numerical(question_text=d['text'], answer=d['answer'], tolerance=d['tolerance'], marks=marks)
+    elif question_type == 'matching_question':
+        Q = Question_Matching(question_text=d['text'], pairs=d['pairs'], distractors=d['distractors'], marks=marks)
+    elif question_type == 'fill_in_multiple_blanks_question':
+        Q = Question_FillInBlanks(question_text=d['text'], blanks=d['blanks'], marks=marks)
+    else:
+        return None
+    return Q
+
+def IterQtiFile(zip_filename, media_dir='Squid_imported_media', verbose=False):
+    '''
+    Yields the questions in the QTI package zip_filename (with extension), e.g. a quiz exported from Canvas
+    or a pool saved with SaveToQtiFile, one at a time as Squid questions. The package is read incrementally,
+    so even huge packages can be re-indexed or re-exported without holding them in memory.
+    Images are restored from the package into the folder media_dir.
+    Question types Squid doesn't support are skipped (with a message if verbose is True).
+    '''
+    for d in ReadQtiFile(zip_filename, media_dir=media_dir):
+        Q = qti2squid(d)
+        if Q is None:
+            if verbose:
+                print(f"Squid doesn't support question type {d['question_type']}. {d['title']} ignored.")
+            continue
+        yield Q
+
+def LoadFromQtiFile(zip_filename, media_dir='Squid_imported_media', verbose=False):
+    '''Returns a list of the questions in the QTI package zip_filename (with extension). See IterQtiFile.'''
+    return list(IterQtiFile(zip_filename, media_dir=media_dir, verbose=verbose))
+
 def SaveToBBfile(L, filename):
     '''Saves a list L of questions to a file for uploading to Blackboard.'''
     with open(filename,'w') as f:
         for Q in L:
             Q.write_BB_row(f)
 
-def save_pool(pool, filename, zip_it=True, clean_up=False):
+POOL_FORMAT_VERSION = 1  # bump this when the meaning of stored attributes changes, and teach question_from_record
+
+def question_classes():
+    '''Returns a dict mapping each question_type to the Squid class that is used to load such questions.'''
+    return {'WAQ': Question_Written, 'MCQ': Question_MCQ, 'NUM': Question_Numerical, 'MA': Question_MultipleAnswer,
+            'MAT': Question_Matching, 'FIB': Question_FillInBlanks}
+
+def question_record(Q):
+    '''
+    Returns a dict with the data of the question Q, suitable for json: its attributes, plus the tag 'type'
+    (the question_type) and, for information only, the name of its class.
+    Questions of classes defined in a notebook are stored as their Squid base class would store them.
+    '''
+    record = {'type': Q.question_type, 'class': type(Q).__module__+'.'+type(Q).__qualname__}
+    record.update((key, getattr(Q, key)) for key in question_attributes(Q))
+    return record
+
+def question_from_record(record, question_type=None):
+    '''
+    Returns the Squid question stored in the dict record (see question_record). The question is made with
+    the standard class for its type (or for question_type, if given), so it doesn't need the class it was saved from.
+    Attributes missing from older records keep the defaults of the current class.
+    '''
+    cls = question_classes()[question_type or record['type']]
+    Q = cls()
+    for key, value in record.items():
+        if key not in ('type', 'class', 'question_type'):
+            if key == 'rubric' and value == written_rubric:
+                continue  # the class default, rather than a copy per question
+            setattr(Q, key, value)
+    if isinstance(Q, Question_Matching):  # json turns tuples into lists
+        Q.pairs = [tuple(pair) for pair in Q.pairs]
+    return Q
+
+def write_pool(f, pool, media=None):
+    '''
+    Writes the questions in pool (any iterable) to the text file f, in the Squid pool format:
+    JSON lines, starting with a header line {"squid_pool": version}, then one line per question (see question_record).
+    If media is a MediaRegistry, the images of the questions are registered with it on the way.
+    Returns the number of questions written.
+    '''
+    f.write(json.dumps({'squid_pool': POOL_FORMAT_VERSION})+'\n')
+    n = 0
+    for Q in pool:
+        if media is not None:
+            media.add_question(Q)
+        f.write(json.dumps(question_record(Q), default=json_default)+'\n')
+        n += 1
+    return n
+
+def read_pool(f, where=None, replace=None):
+    '''
+    Yields the questions stored in the Squid pool format in the text file f, one at a time.
+    If where is given, it is called with each record (a dict, see question_record) and only the questions
+    for which it returns True are made, so filtering a large pool is cheap.
+    If replace is a dict, its keys are replaced by its values in the raw records, e.g. to fix image paths.
+    '''
+    header = json.loads(f.readline() or '{}')
+    if 'squid_pool' not in header:
+        raise ValueError('Not a Squid pool file.')
+    if header['squid_pool'] > POOL_FORMAT_VERSION:
+        raise ValueError(f"This pool was saved with format version {header['squid_pool']}, "
+                         f"but this version of Squid only reads up to version {POOL_FORMAT_VERSION}. Update Squid!")
+    if replace:
+        escaped = {json.dumps(old)[1:-1]: json.dumps(new)[1:-1] for old, new in replace.items()}
+        pattern = re.compile('|'.join(re.escape(old) for old in sorted(escaped, key=len, reverse=True)))
+    for line in f:
+        if not line.strip():
+            continue
+        if replace:
+            line = pattern.sub(lambda m: escaped[m.group(0)], line)
+        record = json.loads(line, object_hook=json_object_hook)
+        if where is None or where(record):
+            yield question_from_record(record)
+
+def save_pool(pool, filename, zip_it=True, clean_up=False, indexed=False):
     '''
     Save the question pool to filename (a string without file extension).
-    NOTE: Currently pool is assumed to be a list of questions!
-    The pool is saved to a pickle file.
-    If zip_it is True, make a zipfile including the pickle file and all images.
-    If clean_up is True and zip_it is True, delete the pickle file.
-
-    CAUTION: Pickle doesn't save the class definitions, so you need to somehow
-    keep these, too!
-    '''
-    with open(filename+'.pickle', 'wb') as f:
-        pickle.dump(pool, f)
-    if zip_it:
-        images = []
-        for Q in pool:    # Populate a list of all image filenames used in questions in L
-            images = images + get_img_filenames(Q.q_text())
-            if Q.question_type == 'MCQ':
-                images = images + get_img_filenames(Q.answer)
-                for wa in Q.wrong_answers:
-                    images = images + get_img_filenames(wa)
-        with ZipFile(filename+'.zip', 'w') as zipobj:
-            zipobj.write(filename+'.pickle')
-            if len(images) > 0:  # also add the image files to the zipfile
-                for img in images:
-                    zipobj.write(img)
-        if clean_up:
-            os.remove(filename+'.pickle')
-
-def load_pool(filename, update_to='None', clean_up=False):
-    '''
-    Returns the pool in filename (with extension).
-    If it is a pickle file, unpickle it.
-    If it is a zip file, extract all, then unpickle.
+    pool can be any iterable of questions, e.g. a generator from iter_pool.
+    The pool is saved to filename.jsonl in the Squid pool format (see write_pool), which stores the data of
+    each question with a type tag, so it can be loaded without the classes (or the notebook) that made them.
+    If zip_it is True, make filename.zip including the pool file and all images, each stored once.
+    If clean_up is True and zip_it is True, don't keep the .jsonl file next to the zip file.
+    If indexed is True, save to the PoolStore filename.sqlite instead (replacing it), which allows queries,
+    fetching single questions and lazy loading with Pool. The images are stored in it, too.
+    '''
+    if indexed:
+        if os.path.exists(filename+'.sqlite'):
+            os.remove(filename+'.sqlite')
+        with PoolStore(filename+'.sqlite') as store:
+            store.extend(pool)
+        return
+    if not zip_it:
+        with open(filename+'.jsonl', 'w', encoding='utf-8') as f:
+            write_pool(f, pool)
+        return
+    media = MediaRegistry()
+    with ZipFile(filename+'.zip', 'w', ZIP_DEFLATED) as zipobj:
+        with zipobj.open('pool.jsonl', 'w') as raw, TextIOWrapper(raw, encoding='utf-8') as f:
+            write_pool(f, pool, media)
+        for name, path in media.blobs.items():  # also add the image files to the zipfile
+            zipobj.write(path, 'media/'+name)
+        zipobj.writestr('media.json', json.dumps(media.names))
+        if not clean_up:
+            with zipobj.open('pool.jsonl') as src, open(filename+'.jsonl', 'wb') as dst:
+                copyfileobj(src, dst)
+
+def zip_name(path):
+    '''Returns the name under which ZipFile.write(path) stores the file path, as older Squids saved images.'''
+    name = os.path.normpath(os.path.splitdrive(path)[1])
+    return name.lstrip(os.sep+(os.altsep or '')).replace(os.sep, '/')
+
+def replace_in_question(Q, replace):
+    '''Replaces the keys of the dict replace by its values in the texts of the question Q, e.g. to fix image paths.'''
+    pattern = re.compile('|'.join(re.escape(old) for old in sorted(replace, key=len, reverse=True)))
+    def sub(s):
+        return pattern.sub(lambda m: replace[m.group(0)], s) if isinstance(s, str) else s
+    for key in question_attributes(Q):
+        value = getattr(Q, key)
+        if isinstance(value, str):
+            setattr(Q, key, sub(value))
+        elif isinstance(value, (list, tuple)):
+            setattr(Q, key, type(value)(sub(s) for s in value))
+
+def iter_pool(filename, where=None, media_dir=None):
+    '''
+    Yields the questions in the pool file filename (with extension), one at a time, without loading the whole pool.
+    See read_pool for where.
+    For a zip file made by save_pool, the images are extracted into the folder media_dir (default: filename
+    without extension, followed by _media) and the questions are changed to use them there, also for zip files
+    saved by older versions of Squid.
+    Pools saved with older versions of Squid (.pickle files, or zip files containing them) can still be read,
+    but need the classes they were pickled with. A .sqlite file is read as a PoolStore.
+    '''
+    base_filename, ext = os.path.splitext(filename)
+    if ext.lower() == '.sqlite':
+        with PoolStore(filename, media_dir) as store:
+            for record, images in store.db.execute('SELECT record, images FROM questions ORDER BY key'):
+                if where is None or where(json.loads(record, object_hook=json_object_hook)):
+                    yield store.question(record, images)
+    elif ext.lower() == '.pickle':
+        with open(filename, 'rb') as f:
+            yield from pickle.load(f)
+    elif ext.lower() == '.zip':
+        with ZipFile(filename, 'r') as zipobj:
+            names = zipobj.namelist()
+            if media_dir is None:
+                media_dir = base_filename+'_media'
+            if 'pool.jsonl' not in names:  # made with an older Squid: a pickle, and images with their own paths
+                pickles = [name for name in names if name.endswith('.pickle')]
+                if not pickles:
+                    raise ValueError(f'{filename} is not a Squid pool: it has neither pool.jsonl nor a .pickle file.')
+                extracted = {name: zipobj.extract(name, media_dir) for name in names if name not in pickles}
+                with zipobj.open(pickles[0]) as f:
+                    pool = pickle.load(f)
+                for Q in pool:
+                    replace = {path: extracted[zip_name(path)] for path in get_question_img_filenames(Q)
+                               if zip_name(path) in extracted}
+                    if replace:
+                        replace_in_question(Q, replace)
+                    yield Q
+                return
+            replace = {}
+            for path, name in json.loads(zipobj.read('media.json')).items():
+                new_path = os.path.join(media_dir, name)
+                if not os.path.exists(new_path):
+                    os.makedirs(media_dir, exist_ok=True)
+                    with zipobj.open('media/'+name) as src, open(new_path, 'wb') as dst:
+                        copyfileobj(src, dst)
+                replace[path] = new_path
+            with zipobj.open('pool.jsonl') as raw, TextIOWrapper(raw, encoding='utf-8') as f:
+                yield from read_pool(f, where, replace)
+    else:
+        with open(filename, encoding='utf-8') as f:
+            yield from read_pool(f, where)
+
+def load_pool(filename, update_to='None', clean_up=False, where=None, media_dir=None, lazy=False):
+    '''
+    Returns the pool in filename (with extension) as a list of questions. See iter_pool for where and media_dir.
+    If lazy is True, filename must be a .sqlite file (see save_pool), and a lazy Pool is returned instead.
     If update_to = 'MCQ': update all questions to the latest Question_MCQ
     If update_to = 'WAQ': update all questions to the latest Question_Written
-
-    WARNING: pickle doesn't actually save the type of an object, so this thing
-    actually doesn't work. Must figure out how to persistently save objects...
-    perhpas json it's code?? Use dill?
+    (Questions loaded from .jsonl or zip files are always made with the latest classes.)
+    clean_up is only kept for old code: nothing but the images is extracted from zip files any more.
     '''
-    base_filename, exp = os.path.splitext(filename)
-    if exp.lower() == '.zip':  # we have a zipfile
-        with ZipFile(filename, 'r') as zipobj:
-            zipobj.extractall()
-    with open(base_filename+'pickle', 'rb') as f:
-        pool = pickle.load(f)
-    if clean_up:
-        os.remove(base_filename+'.pickle')
-    if update_to == 'MCQ':
-        return [update_MCQ(Q) for Q in pool]
-    elif update_to == 'WAQ':
-        return [update_written(Q) for Q in pool]
+    if lazy:
+        if not filename.lower().endswith('.sqlite'):
+            raise ValueError('Only indexed pools can be loaded lazily: save the pool with save_pool(..., indexed=True).')
+        return Pool(PoolStore(filename, media_dir))
+    pool = list(iter_pool(filename, where=where, media_dir=media_dir))
+    if update_to in ('MCQ', 'WAQ'):
+        return [question_from_record(question_record(Q), question_type=update_to) for Q in pool]
     else:
         return pool
 
-def PrintMarkingScheme(L, course="MATH1120 2020 S2 ", title="", print_table=True, array_stretch=1):
-    '''Prints a marking scheme for the list L of written-answer questions'''
-    print(r"\documentclass{article}")
-    print(r"\usepackage{amssymb,amsmath,hyperref,a4wide,graphicx}")
-    print()
-    print(r"\begin{document}")
-    if array_stretch != 1:
-        print(r"\renewcommand{\arraystretch}{"+str(array_stretch)+"}")
-    print(r"\setcounter{page}{0}")
-    print(course+title)  # e.g. "MATH1120 - 2020 - Workshop Week 3"
-    print()
-    print(r"Marking scheme for written-answer question")
-    print()
-    if print_table:
-        print(r"\setcounter{section}{-1}")
-        print(r"\section{Variant List}")
-        print()
-        cols = len(L[0].table_row)  # number of columns, excluding first column
-        print(r"\medskip")
-        print(r"\begin{tabular}{|l|"+"".join(["l|" for i in range(cols)])+"}")
-        print(r"\hline")
-        print(r"Variant & "+" & ".join(L[0].table_header)+r"\\ \hline")
-        i=0
-        for Q in L:
-            i+=1
-            if Q.variant_number>0:
-                j=Q.variant_number
-            else:
-                j=i
-            print(r"\hyperref[v"+str(j)+r"]{Variant "+str(j)+r"} & "+" & ".join(Q.table_row)+r"\\ \hline")
-        print(r"\end{tabular}")
-    print()
-    print(r"\medskip")
-    print(r"\begin{small}")
-    print(r"\begin{itemize}")
-    print(r"  \item 1 mark: The student demonstrates a partial understanding of how to do the problem.")
-    print(r"  \item 2 marks: The student demonstrates a good understanding of how to do the problem \\ (some minor errors permitted).")
-    print(r"  \item 3 marks: The student demonstrates a good understanding and obtains the correct answer.")
-    print(r"\end{itemize}")
-    print(r"\end{small}")
-    i=0
-    for Q in L:
-        i+=1
-        if Q.variant_number>0:
-            print(Q.latex_solution_page())
-        else:
-            print(Q.latex_solution_page(i))
-    print(r"\end{document}")
+class PoolEntry(object):
+    '''
+    A row of a PoolStore: the indexed fields of a question, without its text. The question itself is only
+    read from the store (and made) when the attribute question is first accessed.
 
-def TypesetMarkingScheme(L, course="MATH1120 2020 S2 ", title="", print_table=True, array_stretch=1, two_cols=False):
-    '''Returns a marking scheme for the list L of written-answer questions'''
-    s=r"\documentclass{article}"+"\n"+\
-    r"\usepackage{amssymb,amsmath,hyperref,a4wide,longtable,graphicx}"+"\n\n"+\
+    ATTRIBUTES:
+        key : the position of the question in the store (starting from 0)
+        variant_number, question_type, marks : as in the question
+        table_row : list of str, as in the question
+        question : the question (loaded lazily)
+    '''
+    def __init__(self, store, key, variant_number, question_type, marks, table_row):
+        self.store = store
+        self.key = key
+        self.variant_number = variant_number
+        self.question_type = question_type
+        self.marks = marks
+        self.table_row = json.loads(table_row, object_hook=json_object_hook)
+        self._question = None
+
+    @property
+    def question(self):
+        if self._question is None:
+            self._question = self.store[self.key]
+        return self._question
+
+    def __repr__(self):
+        return f'<PoolEntry {self.key}: {self.question_type} variant {self.variant_number}, {self.marks} marks>'
+
+class PoolStore(object):
+    '''
+    A question pool stored in an SQLite database file, for pools too large to load and scan whole.
+
+    Each question is stored as its record (see question_record), with its variant_number, question_type, marks
+    and table_row in indexed columns. So one can fetch a question by its position or variant number
+    without reading the others, and query the columns without reading any question texts:
+
+        with PoolStore('Pool-CritPoints.sqlite') as store:
+            store.extend(L)
+            for entry in store.query(question_type='MCQ', marks=1, table_row='saddle'):
+                display(entry.question)
+
+    The images used by the questions are stored too, each distinct one once. They are only written out, into
+    the folder media_dir (default: filename without extension, followed by _media), when a question using
+    them is loaded, and the loaded question refers to them there.
+
+    A PoolStore can also be used with save_pool(..., indexed=True), load_pool/iter_pool on a .sqlite file,
+    and as the backing of a lazy Pool.
+    '''
+    def __init__(self, filename, media_dir=None):
+        self.filename = filename
+        self.media_dir = os.path.splitext(filename)[0]+'_media' if media_dir is None else media_dir
+        self.db = sqlite3.connect(filename)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS squid_pool (key TEXT PRIMARY KEY, value);
+            CREATE TABLE IF NOT EXISTS questions (
+                key INTEGER PRIMARY KEY, variant_number INTEGER, question_type TEXT, marks NUMERIC,
+                table_row TEXT, record TEXT, images TEXT);
+            CREATE INDEX IF NOT EXISTS questions_variant ON questions (variant_number);
+            CREATE INDEX IF NOT EXISTS questions_type ON questions (question_type, marks);
+            CREATE TABLE IF NOT EXISTS media (name TEXT PRIMARY KEY, data BLOB);
+            CREATE TABLE IF NOT EXISTS media_paths (path TEXT PRIMARY KEY, name TEXT);''')
+        version = self.db.execute("SELECT value FROM squid_pool WHERE key='version'").fetchone()
+        if version is None:
+            self.db.execute("INSERT INTO squid_pool VALUES ('version', ?)", (POOL_FORMAT_VERSION,))
+            self.db.commit()
+        elif version[0] > POOL_FORMAT_VERSION:
+            raise ValueError(f'{filename} was saved with format version {version[0]}, '
+                             f'but this version of Squid only reads up to version {POOL_FORMAT_VERSION}. Update Squid!')
+        self.media_names = dict(self.db.execute('SELECT path, name FROM media_paths'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM questions').fetchone()[0]
+
+    def add_images(self, Q, media):
+        '''Stores the images used by the question Q which aren't stored yet (using the MediaRegistry media
+        to name them by their contents), and returns the list of their paths. Missing files are left out.'''
+        images = [img for img in dict.fromkeys(get_question_img_filenames(Q)) if os.path.exists(img)]
+        for img in images:
+            if img not in self.media_names:
+                name = media.add(img)
+                with open(img, 'rb') as f:
+                    self.db.execute('INSERT OR IGNORE INTO media VALUES (?, ?)', (name, f.read()))
+                self.db.execute('INSERT INTO media_paths VALUES (?, ?)', (img, name))
+                self.media_names[img] = name
+        return images
+
+    def extend(self, pool):
+        '''Adds the questions in pool (any iterable) and their images at the end of the store, in one transaction.'''
+        start = self.db.execute('SELECT COALESCE(MAX(key)+1, 0) FROM questions').fetchone()[0]
+        media = MediaRegistry()
+        rows = ((start+k, Q.variant_number, Q.question_type, getattr(Q, 'marks', None),
+                 json.dumps(list(Q.table_row), default=json_default),
+                 json.dumps(question_record(Q), default=json_default),
+                 json.dumps(self.add_images(Q, media))) for k, Q in enumerate(pool))
+        with self.db:
+            self.db.executemany('INSERT INTO questions VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def append(self, Q):
+        '''Adds the question Q at the end of the store.'''
+        self.extend([Q])
+
+    def question(self, record, images):
+        '''Returns the question made from the json strings record and images, as stored in the table questions.
+        Its images are written to media_dir (if they aren't there already) and its image paths point there.'''
+        for img in json.loads(images):
+            name = self.media_names[img]
+            path = os.path.join(self.media_dir, name)
+            if not os.path.exists(path):
+                os.makedirs(self.media_dir, exist_ok=True)
+                data = self.db.execute('SELECT data FROM media WHERE name=?', (name,)).fetchone()[0]
+                with open(path, 'wb') as f:
+                    f.write(data)
+            record = record.replace(json.dumps(img)[1:-1], json.dumps(path)[1:-1])
+        return question_from_record(json.loads(record, object_hook=json_object_hook))
+
+    def __getitem__(self, key):
+        '''Returns the question at position key (starting from 0).'''
+        row = self.db.execute('SELECT record, images FROM questions WHERE key=?', (key,)).fetchone()
+        if row is None:
+            raise IndexError(f'There is no question {key} in {self.filename}.')
+        return self.question(*row)
+
+    def variant(self, variant_number):
+        '''Returns the (first) question with the given variant number.'''
+        row = self.db.execute('SELECT record, images FROM questions WHERE variant_number=? ORDER BY key LIMIT 1',
+                              (variant_number,)).fetchone()
+        if row is None:
+            raise KeyError(f'There is no variant {variant_number} in {self.filename}.')
+        return self.question(*row)
+
+    def questions(self, keys):
+        '''Returns the list of questions at the positions in keys, read with a single query.'''
+        rows = dict((key, (record, images)) for key, record, images in self.db.execute(
+            f'SELECT key, record, images FROM questions WHERE key IN ({",".join("?"*len(keys))})', list(keys)))
+        return [self.question(*rows[key]) for key in keys]
+
+    def query(self, question_type=None, marks=None, variant_number=None, table_row=None):
+        '''
+        Returns a list of PoolEntry for the questions matching all the given conditions, in order.
+        variant_number can be a number or a (first, last) range; table_row is a string that one of the
+        entries of the table_row has to contain (ignoring case). Conditions that are None are ignored.
+        The question texts are only read when the entries' questions are used.
+        '''
+        conditions, values = [], []
+        if question_type is not None:
+            conditions.append('question_type=?')
+            values.append(question_type)
+        if marks is not None:
+            conditions.append('marks=?')
+            values.append(marks)
+        if isinstance(variant_number, (tuple, list)):
+            conditions.append('variant_number BETWEEN ? AND ?')
+            values.extend(variant_number)
+        elif variant_number is not None:
+            conditions.append('variant_number=?')
+            values.append(variant_number)
+        if table_row is not None:
+            conditions.append("table_row LIKE ? ESCAPE '\\'")
+            values.append('%'+re.sub(r'([\\%_])', r'\\\1', json.dumps(table_row)[1:-1])+'%')
+        sql = 'SELECT key, variant_number, question_type, marks, table_row FROM questions'
+        if conditions:
+            sql += ' WHERE '+' AND '.join(conditions)
+        return [PoolEntry(self, *row) for row in self.db.execute(sql+' ORDER BY key', values)]
+
+    def __iter__(self):
+        '''Yields all questions in the store, in order.'''
+        for record, images in self.db.execute('SELECT record, images FROM questions ORDER BY key'):
+            yield self.question(record, images)
+
+class Pool(Sequence):
+    '''
+    A lazy list of questions, backed by a PoolStore (or the name of a .sqlite file made with
+    save_pool(..., indexed=True)). It can be used wherever a list of questions is accepted, e.g. by
+    SaveToQtiFile, TypesetMarkingScheme or selection_wizard.
+
+    Only the PoolEntry of each question (variant number, type, marks, table_row) is kept in memory.
+    A question, with its text and images, is read from the store each time it is accessed, so changes to it
+    are not kept. Slicing gives another Pool, and iteration reads the questions in chunks:
+
+        L = Pool('Pool-CritPoints.sqlite')
+        SaveToQtiFile(L[:100], 'first_hundred')
+        saddles = L.query(table_row='saddle')
+
+    entries : list of PoolEntry, the questions in this Pool (default: all questions in the store)
+    chunksize : the number of questions read at a time when iterating
+    '''
+    def __init__(self, store, entries=None, chunksize=256):
+        if not isinstance(store, PoolStore):
+            store = PoolStore(store)
+        self.store = store
+        self.entries = store.query() if entries is None else entries
+        self.chunksize = chunksize
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return Pool(self.store, self.entries[k], self.chunksize)
+        return self.store[self.entries[k].key]
+
+    def chunks(self, chunksize=None):
+        '''Yields the questions in lists of (at most) chunksize questions, each read with one query.'''
+        chunksize = chunksize or self.chunksize
+        for k in range(0, len(self.entries), chunksize):
+            yield self.store.questions([entry.key for entry in self.entries[k:k+chunksize]])
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            yield from chunk
+
+    def query(self, question_type=None, marks=None, variant_number=None, table_row=None):
+        '''Returns the Pool of the questions in this Pool matching all the conditions (see PoolStore.query).'''
+        keys = {entry.key for entry in self.store.query(question_type, marks, variant_number, table_row)}
+        return Pool(self.store, [entry for entry in self.entries if entry.key in keys], self.chunksize)
+
+    def __repr__(self):
+        return f'<Pool of {len(self)} questions from {self.store.filename}>'
+
+def table_rows(L):
+    '''Returns the table_row of each question in L, without loading the questions if L is a Pool.'''
+    if isinstance(L, Pool):
+        return [entry.table_row for entry in L.entries]
+    return [Q.table_row for Q in L]
+
+def variant_table_rows(L):
+    '''
+    Returns a list of pairs (variant number, table_row) for the questions in L, as listed in the marking scheme:
+    questions without a variant number are numbered by their position in L, starting from 1.
+    Doesn't load the questions if L is a Pool.
+    '''
+    items = L.entries if isinstance(L, Pool) else L
+    return [(x.variant_number if x.variant_number > 0 else i, x.table_row) for i, x in enumerate(items, 1)]
+
+marking_scheme_packages = 'amssymb,amsmath,hyperref,a4wide,longtable,graphicx'
+
+def iter_marking_scheme_front(L, course="MATH1120 2020 S2 ", title="", print_table=True, array_stretch=1,
+                              two_cols=False, packages=marking_scheme_packages):
+    '''Yields the start of the marking scheme (see iter_marking_scheme), up to the solution pages.'''
+    yield r"\documentclass{article}"+"\n"+\
+    r"\usepackage{"+packages+"}"+"\n\n"+\
     r"\begin{document}"
     if array_stretch != 1:
-        s+=r"\renewcommand{\arraystretch}{"+str(array_stretch)+"}"
-    s+=r"\setcounter{page}{0}"+"\n"+\
+        yield r"\renewcommand{\arraystretch}{"+str(array_stretch)+"}"
+    yield r"\setcounter{page}{0}"+"\n"+\
     r"{\Large "+course+" "+title+r"}"+"\n\n"+\
     r"Marking scheme for written-answer question"+"\n\n"
-
+    first = L[0]
     if print_table:
-        s+=r"\setcounter{section}{-1}"+"\n\n"+\
+        yield r"\setcounter{section}{-1}"+"\n\n"+\
         r"\section{Variant List}"+"\n\n"
-        cols = len(L[0].table_row)  # number of columns, excluding first column
-        s+=r"\medskip"+"\n"
+        cols = len(first.table_row)  # number of columns, excluding first column
+        yield r"\medskip"+"\n"
+        rows = [r"\hyperref[v"+str(j)+r"]{Variant "+str(j)+r"} & "+" & ".join(table_row)
+                for j, table_row in variant_table_rows(L)]
         if two_cols:  # the table would be too long, make two entries per table row
-            s=s+r"\begin{longtable}{|l|"+"".join(["l|" for i in range(cols)])+"|l|"+"".join(["l|" for i in range(cols)])+"}"+\
+            yield r"\begin{longtable}{|l|"+"".join(["l|" for i in range(cols)])+"|l|"+"".join(["l|" for i in range(cols)])+"}"+\
             r"\hline"+"\n"+\
-            r"Variant & "+" & ".join(L[0].table_header)+ r"& Variant & "+" & ".join(L[0].table_header)+ r"\\ \hline"+"\n"
-            for i in range(0,len(L),2):
-                Q = L[i]
-                if Q.variant_number>0:
-                    j = Q.variant_number
+            r"Variant & "+" & ".join(first.table_header)+ r"& Variant & "+" & ".join(first.table_header)+ r"\\ \hline"+"\n"
+            for i in range(0, len(rows), 2):
+                if i < len(rows)-1:
+                    yield rows[i]+r"& "+rows[i+1]+r"\\ \hline"+"\n"
                 else:
-                    j = i
-                s += r"\hyperref[v"+str(j)+r"]{Variant "+str(j)+r"} & "+" & ".join(Q.table_row)
-                if i < len(L)-1:
-                    Q = L[i+1]
-                    if Q.variant_number>0:
-                        j = Q.variant_number
-                    else:
-                        j = i+1
-                    s += r"& \hyperref[v"+str(j)+r"]{Variant "+str(j)+r"} & "+" & ".join(Q.table_row)+r"\\ \hline"+"\n"
-                else:
-                    s += "& & "+"&".join(' ' for entry in Q.table_row)+r"\\ \hline"+"\n"
+                    yield rows[i]+"& & "+"&".join(' ' for entry in first.table_row)+r"\\ \hline"+"\n"
         else: # make a single table
-            s=s+r"\begin{longtable}{|l|"+"".join(["l|" for i in range(cols)])+'}\n'+\
+            yield r"\begin{longtable}{|l|"+"".join(["l|" for i in range(cols)])+'}\n'+\
             r"\hline"+"\n"+\
-            r"Variant & "+" & ".join(L[0].table_header)+r"\\ \hline"+"\n"
-            i=0
-            for Q in L:
-                i+=1
-                if Q.variant_number>0:
-                    j=Q.variant_number
-                else:
-                    j=i
-                s+=r"\hyperref[v"+str(j)+r"]{Variant "+str(j)+r"} & "+" & ".join(Q.table_row)+r"\\ \hline"+"\n"
-        s+=r"\end{longtable}"+"\n\n"
-    s+=r"\medskip"+"\n"
-    s+=L[0].rubric+"\n\n"
-    i=0
-    for Q in L:
-        i+=1
-        if Q.variant_number>0:
-            s+=Q.latex_solution_page()+"\n\n"
-        else:
-            s+=Q.latex_solution_page(i)+"\n\n"
-    s+=r"\end{document}"
-    return(s)
+            r"Variant & "+" & ".join(first.table_header)+r"\\ \hline"+"\n"
+            for row in rows:
+                yield row+r"\\ \hline"+"\n"
+        yield r"\end{longtable}"+"\n\n"
+    yield r"\medskip"+"\n"
+    yield first.rubric+"\n\n"
+
+def iter_solution_pages(L, start=1, workers=1, batch_size=4096):
+    '''Yields the solution pages of the questions in L for the marking scheme; the questions without a
+    variant number are numbered by their position, counting from start.
+    The question texts are converted to LaTeX with convert_many, batch_size questions at a time,
+    in workers processes (see convert_many).'''
+    questions = iter(L)
+    i = start
+    while True:
+        batch = list(itertools.islice(questions, batch_size))
+        if not batch:
+            return
+        convert_many([Q.q_text() for Q in batch], workers)
+        for Q in batch:
+            if Q.variant_number>0:
+                yield Q.latex_solution_page()+"\n\n"
+            else:
+                yield Q.latex_solution_page(i)+"\n\n"
+            i += 1
+
+def iter_marking_scheme(L, course="MATH1120 2020 S2 ", title="", print_table=True, array_stretch=1, two_cols=False,
+                        workers=1):
+    '''
+    Yields the marking scheme for the list (or Pool) L of written-answer questions as a LaTeX document, in chunks,
+    so it can be written out as it is made: only a batch of solution pages is worked on at a time.
+    See WriteMarkingScheme, SaveMarkingScheme, PrintMarkingScheme and TypesetMarkingScheme.
+    For huge pools, workers > 1 converts the question texts in parallel (see convert_many).
+    '''
+    yield from iter_marking_scheme_front(L, course, title, print_table, array_stretch, two_cols)
+    yield from iter_solution_pages(L, workers=workers)
+    yield r"\end{document}"
+
+def WriteMarkingScheme(L, f, course="MATH1120 2020 S2 ", title="", print_table=True, array_stretch=1, two_cols=False,
+                       workers=1):
+    '''Writes the marking scheme for the list L of questions to f, any file-like object with a write method.'''
+    for chunk in iter_marking_scheme(L, course=course, title=title, print_table=print_table,
+                                     array_stretch=array_stretch, two_cols=two_cols, workers=workers):
+        f.write(chunk)
+
+def PrintMarkingScheme(L, course="MATH1120 2020 S2 ", title="", print_table=True, array_stretch=1, two_cols=False,
+                       workers=1):
+    '''Prints a marking scheme for the list L of written-answer questions'''
+    WriteMarkingScheme(L, sys.stdout, course=course, title=title, print_table=print_table,
+                       array_stretch=array_stretch, two_cols=two_cols, workers=workers)
+    print()
+
+def TypesetMarkingScheme(L, course="MATH1120 2020 S2 ", title="", print_table=True, array_stretch=1, two_cols=False,
+                         workers=1):
+    '''Returns a marking scheme for the list L of written-answer questions'''
+    return ''.join(iter_marking_scheme(L, course=course, title=title, print_table=print_table,
+                                       array_stretch=array_stretch, two_cols=two_cols, workers=workers))
 
-def SaveMarkingScheme(L, filename, course="MATH1120 2020 S2 ", title="", print_table=True, array_stretch=1, two_cols=False):
+def SaveMarkingScheme(L, filename, course="MATH1120 2020 S2 ", title="", print_table=True, array_stretch=1,
+                      two_cols=False, workers=1):
     '''Writes the marking scheme for the list L of questions to filename.'''
     with open(filename,'w') as f:
-        f.write(TypesetMarkingScheme(L,course=course,
-                                    title=title,
-                                    print_table=print_table,
-                                    array_stretch=array_stretch,
-                                    two_cols=two_cols))
+        WriteMarkingScheme(L, f, course=course, title=title, print_table=print_table,
+                           array_stretch=array_stretch, two_cols=two_cols, workers=workers)
+
+def _run_pdflatex(job):
+    '''Runs pdflatex on one .tex file for compile_latex; returns (tex_filename, error message or None).'''
+    pdflatex, tex_filename, build_dir = job
+    result = subprocess.run([pdflatex, '-interaction=nonstopmode', '-halt-on-error', '-output-directory='+build_dir,
+                             tex_filename], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if result.returncode != 0:
+        base_filename = os.path.join(build_dir, os.path.splitext(os.path.basename(tex_filename))[0])
+        for ext in ('.pdf', '.aux'):  # don't leave (partial) outputs that would look up to date next time
+            if os.path.exists(base_filename+ext):
+                os.remove(base_filename+ext)
+        return tex_filename, result.stdout.decode('utf-8', 'replace')[-3000:]
+    return tex_filename, None
+
+def compile_latex(tex_filenames, build_dir, workers=None, pdflatex='pdflatex'):
+    '''
+    Compiles the LaTeX files tex_filenames with pdflatex (which must be installed), putting the output in build_dir,
+    with workers (default: one per CPU) running at a time. Raises RuntimeError if any of them fails.
+    '''
+    jobs = [(pdflatex, tex_filename, build_dir) for tex_filename in tex_filenames]
+    if not jobs:
+        return
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    with ThreadPool(workers) as pool:  # threads are enough to wait for pdflatex processes
+        for tex_filename, error in pool.imap_unordered(_run_pdflatex, jobs):
+            if error is not None:
+                raise RuntimeError(f'pdflatex failed on {tex_filename}:\n{error}')
+
+def write_if_changed(tex_filename, tex, outputs=('.pdf',)):
+    '''
+    Writes the LaTeX code tex to tex_filename, unless the file already contains it and its outputs (the files with the
+    same name and the extensions in outputs) exist. Returns True if it needs to be compiled (again).
+    The old outputs are deleted then, so that they can't be mistaken for up to date ones if compiling fails.
+    '''
+    base_filename = os.path.splitext(tex_filename)[0]
+    if os.path.exists(tex_filename) and all(os.path.exists(base_filename+ext) for ext in outputs):
+        with open(tex_filename, encoding='utf-8') as f:
+            if f.read() == tex:
+                return False
+    for ext in outputs:
+        if os.path.exists(base_filename+ext):
+            os.remove(base_filename+ext)
+    with open(tex_filename, 'w', encoding='utf-8') as f:
+        f.write(tex)
+    return True
+
+def BuildMarkingScheme(L, filename, course="MATH1120 2020 S2 ", title="", print_table=True, array_stretch=1,
+                       two_cols=False, shard_size=50, workers=None, pdflatex='pdflatex', build_dir=None, verbose=True):
+    '''
+    Compiles the marking scheme for the list (or Pool) L of questions to a pdf file, using pdflatex (which must be
+    installed), and returns its filename: filename with the extension .pdf.
+
+    The solution pages are split into shards of shard_size variants, each compiled as a standalone pdf, in
+    parallel (workers at a time, default: one per CPU). The shards are kept in build_dir (default: filename
+    without extension followed by _build), and a shard is only compiled again if its LaTeX has changed.
+    The main document holds the title and the variant table and includes the pages of the shards,
+    with the labels v1, v2, ... of the variants, so the links in the variant table work as before.
+    '''
+    base_filename = os.path.splitext(filename)[0]
+    if build_dir is None:
+        build_dir = base_filename+'_build'
+    os.makedirs(build_dir, exist_ok=True)
+    name = os.path.basename(base_filename)
+    shards = []  # (tex filename, changed?)
+    for k in range(0, len(L), shard_size):
+        tex = ''.join([r"\documentclass{article}"+"\n"+r"\usepackage{"+marking_scheme_packages+"}"+"\n\n"+
+                       r"\begin{document}"+"\n"+r"\pagestyle{empty}"+"\n"+
+                       (r"\renewcommand{\arraystretch}{"+str(array_stretch)+"}\n" if array_stretch != 1 else "")+
+                       r"\setcounter{section}{"+str(k)+"}\n"]
+                      +list(iter_solution_pages(L[k:k+shard_size], start=k+1))+[r"\end{document}"])
+        tex_filename = os.path.join(build_dir, f'{name}_shard{k//shard_size:04d}.tex')
+        shards.append((tex_filename, write_if_changed(tex_filename, tex, outputs=('.pdf', '.aux'))))
+    stale = [tex_filename for tex_filename, changed in shards if changed]
+    if verbose:
+        print(f'Compiling {len(stale)} of {len(shards)} shards.')
+    compile_latex(stale, build_dir, workers, pdflatex)
+
+    # The main document: the front matter, then the pages of the shards, putting the variants' labels
+    # on the pages where their solutions start (as recorded in the .aux files of the shards).
+    main_filename = os.path.join(build_dir, name+'.tex')
+    with open(main_filename, 'w', encoding='utf-8') as f:
+        for chunk in iter_marking_scheme_front(L, course, title, print_table, array_stretch, two_cols,
+                                               packages=marking_scheme_packages+',pdfpages'):
+            f.write(chunk)
+        for tex_filename, _ in shards:
+            with open(os.path.splitext(tex_filename)[0]+'.aux', encoding='utf-8') as aux:
+                labels = re.findall(r'\\newlabel\{v([^}]*)\}\{\{[^}]*\}\{(\d+)\}', aux.read())
+            toc = ','.join(f'{page},section,1,Variant {j},v{j}' for j, page in labels)
+            pdf_filename = os.path.splitext(tex_filename)[0]+'.pdf'
+            f.write(r"\includepdf[pages=-,pagecommand={\thispagestyle{plain}},addtotoc={"+toc+"}]{"
+                    +pdf_filename.replace(os.sep, '/')+"}\n")
+        f.write(r"\end{document}")
+    for run in range(2):  # twice, for the links in the variant table
+        compile_latex([main_filename], build_dir, 1, pdflatex)
+    pdf_filename = base_filename+'.pdf'
+    os.replace(os.path.join(build_dir, name+'.pdf'), pdf_filename)
+    if verbose:
+        print(f'Marking scheme saved to {pdf_filename}.')
+    return pdf_filename
 
 def selection_wizard(L,
                     course_name='MATH1120-LS-2022',
@@ -487,7 +1599,7 @@ def selection_wizard(L,
     L_selected = []
     items = [widgets.ToggleButton(description="variant "+str(i), button_style='', value=True) for i in range(len(L))]
     master = widgets.VBox([widgets.HBox(
-        [items[i], widgets.HTMLMath(value="   :   ".join([a for a in L[i].table_row]))]) for i in range(len(L))])
+        [items[i], widgets.HTMLMath(value="   :   ".join([a for a in row]))]) for i, row in enumerate(table_rows(L))])
     display(master)
     # widgets.Label(value=str([c.value for c in items]))
     out = widgets.Output(layout={'border': '1px solid black'}, description='Status:')
@@ -595,9 +1707,9 @@ def selection_wizard(L,
         with out:
             print('Marking Scheme:')
             print()
-            print(TypesetMarkingScheme(L_selected, course=CourseName.value, title=QuizTitle.value,
-                                       array_stretch=MarkingSchemeArrayStretch.value,
-                                       two_cols=MakeTwoColumn.value))
+            PrintMarkingScheme(L_selected, course=CourseName.value, title=QuizTitle.value,
+                               array_stretch=MarkingSchemeArrayStretch.value,
+                               two_cols=MakeTwoColumn.value)
     Button_PrintMarkingScheme.on_click(PrintMarkingSchemeB)
 
     Button_SaveBB = widgets.Button(description="Save Blackboard file")
@@ -688,7 +1800,7 @@ def selection_wizard(L,
         if SavePoolzipit.value:
             fn = SavePoolfilename.value+'.zip'
         else:
-            fn = SavePoolfilename.value+'.pickle'
+            fn = SavePoolfilename.value+'.jsonl'
         with out:
             save_pool(L, filename=SavePoolfilename.value, zip_it=SavePoolzipit.value, clean_up=SavePoolcleanup.value)
             print(f'Questions {[i for i in range(len(L)) if items[i].value]} saved to {fn}.')
@@ -721,8 +1833,8 @@ def selection_wizard(L,
 
     def on_change_master_mode(change):
         if change['new'] == 'Table Row':
-            for i in range(len(L)):
-                master.children[i].children[1].value="   :   ".join([a for a in L[i].table_row])
+            for i, row in enumerate(table_rows(L)):
+                master.children[i].children[1].value="   :   ".join([a for a in row])
         elif change['new'] == 'Question Preview':
             for i in range(len(L)):
                 master.children[i].children[1].value = L[i].q_text()
@@ -0,0 +1,164 @@
+# Squid Ink: paper-based quizzes.
+#
+# Every student on a roster gets their own exam: one variant from each of a list of question pools and,
+# for multiple choice questions, their own order of the answers. The exams are written as one LaTeX document
+# per student, together with an answer key, and compiled with pdflatex in parallel.
+#
+# Example:
+#     roster = [('c1234567', 'Ada Lovelace'), ('c7654321', 'Alan Turing'), ...]   # or just the student numbers
+#     pdfs = MakePaperExams(roster, [pool1, pool2, pool3], course='MATH1120 2022 S2', title='Quiz 1', seed=2022)
+#
+# The assignment of variants only depends on the seed and the student number, so a student added to the roster
+# later doesn't change anyone else's exam, and running MakePaperExams again only recompiles the exams that changed.
+
+import os
+import re
+import csv
+import random
+from copy import copy
+from squid import compile_latex, write_if_changed
+from squid_utils import convert_many
+
+exam_packages = 'amssymb,amsmath,a4wide,graphicx,longtable'
+
+latex_special = {'\\': r'\textbackslash{}', '{': r'\{', '}': r'\}', '$': r'\$', '&': r'\&', '%': r'\%', '#': r'\#',
+                 '_': r'\_', '^': r'\^{}', '~': r'\~{}'}
+latex_special_pattern = re.compile('|'.join(re.escape(c) for c in latex_special))
+
+def latex_escape(s):
+    '''Returns the plain text s (e.g. a student's name) with the characters special to LaTeX escaped.'''
+    return latex_special_pattern.sub(lambda m: latex_special[m.group(0)], s)
+
+def roster_entry(student):
+    '''Returns (student number, name) for an entry of a roster: a pair like that, or just a student number.'''
+    if isinstance(student, (list, tuple)):
+        return str(student[0]), str(student[1])
+    return str(student), ''
+
+def assign_variants(roster, pools, seed=0):
+    '''
+    Returns a dict mapping each student number in roster to their assignment: a list with a pair
+    (index of the variant, shuffle seed) for each pool in pools (lists of questions).
+    It only depends on seed and the student number, not on the rest of the roster.
+    '''
+    assignments = {}
+    for student in roster:
+        student_id, _ = roster_entry(student)
+        rng = random.Random(f'{seed}/{student_id}')
+        assignments[student_id] = [(rng.randrange(len(pool)), rng.randint(1, 10**6)) for pool in pools]
+    return assignments
+
+def exam_questions(pools, assignment):
+    '''
+    Returns the questions of one student's exam, given their assignment (see assign_variants): copies of the
+    assigned variants, with the answers of multiple choice questions shuffled by the assigned seed.
+    '''
+    questions = []
+    for pool, (k, shuffle_seed) in zip(pools, assignment):
+        Q = copy(pool[k])
+        if Q.question_type == 'MCQ':
+            Q.shuffle(shuffle_seed)
+        questions.append(Q)
+    return questions
+
+def answer_letter(Q):
+    '''Returns the letter of the correct answer of the shuffled multiple choice question Q, as printed on the exam,
+    or '' for other questions.'''
+    if Q.question_type == 'MCQ':
+        return 'ABCD'[Q.answer_index]
+    return ''
+
+def latex_exam(student, questions, course='', title='', answer_space='5cm'):
+    '''
+    Returns a LaTeX document with the exam of student (see roster_entry) made of questions (see exam_questions).
+    The student's name and number are escaped (see latex_escape); course and title are LaTeX.
+    Multiple choice questions are typeset with their shuffled answers, the others are followed by
+    answer_space of room for the answer.
+    '''
+    student_id, name = map(latex_escape, roster_entry(student))
+    chunks = [r"\documentclass{article}"+"\n"+r"\usepackage{"+exam_packages+"}"+"\n\n"+r"\begin{document}"+"\n",
+              r"{\Large "+course+" "+title+r"}"+"\n\n"+r"\bigskip"+"\n",
+              r"\noindent Name: "+name+r" \hfill Student number: "+student_id+"\n\n"+r"\bigskip"+"\n",
+              r"\begin{enumerate}"+"\n"]
+    for Q in questions:
+        marks = getattr(Q, 'marks', None)
+        chunks.append(r"\item "+(f"({marks} mark{'s' if marks != 1 else ''}) " if marks else ""))
+        if Q.question_type == 'MCQ':
+            chunks.append(Q.latex_shuffled()+"\n\n")
+        else:
+            chunks.append(Q.latex_question_text()+"\n\n"+r"\vspace{"+answer_space+"}\n\n")
+    chunks.append(r"\end{enumerate}"+"\n"+r"\end{document}")
+    return ''.join(chunks)
+
+def answer_key_rows(roster, pools, assignments):
+    '''
+    Yields a row of the answer key for each question of each student: the student number, name, question number
+    (from 1), variant number, shuffle seed and the letter of the correct answer (for multiple choice questions).
+    '''
+    for student in roster:
+        student_id, name = roster_entry(student)
+        for i, Q in enumerate(exam_questions(pools, assignments[student_id]), 1):
+            yield (student_id, name, i, Q.variant_number, Q.shuffle_seed if Q.question_type == 'MCQ' else '',
+                   answer_letter(Q))
+
+def latex_answer_key(roster, pools, assignments, course='', title=''):
+    '''
+    Returns a LaTeX document with the answer key: a table with a row for each student, listing for each question
+    the variant number and, for multiple choice questions, the letter of the correct answer.
+    '''
+    n = len(pools)
+    chunks = [r"\documentclass{article}"+"\n"+r"\usepackage{"+exam_packages+"}"+"\n\n"+r"\begin{document}"+"\n",
+              r"{\Large "+course+" "+title+r"}"+"\n\n"+r"Answer key"+"\n\n"+r"\medskip"+"\n",
+              r"\begin{longtable}{|l|l|"+"l|"*n+"}\n"+r"\hline"+"\n",
+              r"Student number & Name & "+" & ".join(f"Q{i}" for i in range(1, n+1))+r"\\ \hline"+"\n"]
+    row = []
+    for student_id, name, i, variant_number, shuffle_seed, letter in answer_key_rows(roster, pools, assignments):
+        row.append(f"V{variant_number} {letter}".strip())
+        if i == n:
+            chunks.append(latex_escape(student_id)+" & "+latex_escape(name)+" & "+" & ".join(row)+r"\\ \hline"+"\n")
+            row = []
+    chunks.append(r"\end{longtable}"+"\n"+r"\end{document}")
+    return ''.join(chunks)
+
+def SaveAnswerKey(roster, pools, assignments, filename):
+    '''Writes the answer key as a csv file, with one row per question per student (see answer_key_rows).'''
+    with open(filename, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['student_number', 'name', 'question', 'variant_number', 'shuffle_seed', 'answer'])
+        writer.writerows(answer_key_rows(roster, pools, assignments))
+
+def MakePaperExams(roster, pools, directory='Squid_Ink', course='', title='', seed=0, answer_space='5cm',
+                   compile_pdf=True, workers=None, pdflatex='pdflatex', verbose=True):
+    '''
+    Makes a personalised paper exam for each student in roster (student numbers, or pairs (student number, name)),
+    with a variant of a question from each pool in pools (lists of questions, see assign_variants).
+    Writes to directory one LaTeX file per student, named by student number, plus answer_key.tex and answer_key.csv.
+    If compile_pdf is True, these are compiled with pdflatex, workers at a time (default: one per CPU),
+    skipping files that haven't changed since they were last compiled.
+    Returns the list of the students' .tex (or, if compiled, .pdf) filenames, in the order of roster.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    assignments = assign_variants(roster, pools, seed)
+    convert_many([Q.q_text() for pool in pools for Q in pool], workers)  # each variant's text is converted once
+    outputs = ('.pdf',) if compile_pdf else ()
+    filenames = []
+    stale = []
+    for student in roster:
+        student_id, _ = roster_entry(student)
+        tex = latex_exam(student, exam_questions(pools, assignments[student_id]), course, title, answer_space)
+        tex_filename = os.path.join(directory, re.sub(r'[^\w-]', '_', student_id)+'.tex')
+        if write_if_changed(tex_filename, tex, outputs):
+            stale.append(tex_filename)
+        filenames.append(tex_filename)
+    key_filename = os.path.join(directory, 'answer_key.tex')
+    if write_if_changed(key_filename, latex_answer_key(roster, pools, assignments, course, title), outputs):
+        stale.append(key_filename)
+    SaveAnswerKey(roster, pools, assignments, os.path.join(directory, 'answer_key.csv'))
+    if not compile_pdf:
+        return filenames
+    if verbose:
+        print(f'Compiling {len(stale)} of {len(filenames)+1} documents.')
+    compile_latex(stale, directory, workers, pdflatex)
+    if verbose:
+        print(f'Exams saved to {directory}.')
+    return [os.path.splitext(tex_filename)[0]+'.pdf' for tex_filename in filenames]
@@ -1,4 +1,25 @@
 from sage.misc.latex import latex
+from sage.all import var, matrix, ZZ
+import numpy as np
+from squid_utils import memoize
+
+# Memoized versions of expensive Sage operations, for variant generators that call them with the same arguments
+# over and over (see squid_utils.memoize). Their results are kept on disk in squid_utils.memo_cache, across sessions.
+
+@memoize
+def memo_latex(x):
+    '''Returns latex(x), remembered in memo_cache.'''
+    return latex(x)
+
+@memoize
+def memo_diff(f, *args):
+    '''Returns the derivative f.derivative(*args), e.g. memo_diff(f, x, 3), remembered in memo_cache.'''
+    return f.derivative(*args)
+
+@memoize
+def memo_rref(A):
+    '''Returns the reduced row echelon form of the matrix A, remembered in memo_cache.'''
+    return A.rref()
 
 def nicify(s):
     '''Performs some simplification of LaTeX code in s, only suitable in some cases.'''
@@ -50,117 +71,75 @@ def suppress1(x):
     else:
         return(latex(x))
 
-def Taylor(f, a=0, n=10):
-    '''Returns a latex string for the degree n Taylor polynomial of f about x=a.'''
-    # produces the degree n Taylor polynomial of f about x=a, returns it as a latex string
+@memoize
+def Taylor_coefficients(f, a=0, n=10):
+    '''Returns the list of the coefficients c_0, ..., c_n of the degree n Taylor polynomial of f about x=a.
+    Each derivative is computed from the previous one, rather than from f.'''
+    x = var('x')
+    values = []  # the values of the derivatives of f at a
+    d = f
+    for i in range(n+1):
+        if i > 0:
+            d = d.derivative(x)
+        values.append(d(a))
+    coefficients = []
+    i_factorial = 1
+    for i, value in enumerate(values):
+        if i > 0:
+            i_factorial *= i
+        coefficients.append(value/i_factorial)
+    return coefficients
+
+def Taylor_latex(coefficients, a=0):
+    '''Returns a latex string for the Taylor polynomial about x=a with the given coefficients
+    (e.g. from Taylor_coefficients), with powers of x (or x-a) rather than the simplified form Sage would give.'''
+    x = var('x')
+    if a == 0:
+        base = 'x'
+    elif a > 0:
+        base = '(x-'+latex(a)+')'
+    else:
+        base = '(x+'+latex(-a)+')'
+    s = ''
+    for i, c in enumerate(coefficients):
+        if c == 0:
+            continue
+        if i == 0:
+            if c == 1:
+                s = latex(1)
+            elif c == -1:
+                s = latex(-1)
+            else:
+                s = latex(c*x).replace('x', '')  # latex(c*x) encapsulates c in brackets if necessary
+            continue
+        term = base if i == 1 else base+'^{'+latex(i)+'}'
+        if c == 1:
+            if len(s) > 0:
+                s = s+'+'
+            s = s+term
+        elif c == -1:
+            s = s+'-'+term
+        else:
+            sc = latex(c*x).replace('x', '')
+            if i == 1 and a == 0:  # as it always was for the linear term about 0
+                if not c < 0 and len(s) > 0:
+                    s = s+'+'
+            elif (len(s) > 0) & (sc[0] != '-'):
+                s = s+'+'
+            s = s+sc+term
+    return s
+
+@memoize(version=1)
+def Taylor(f, a=0, n=10, with_coefficients=False):
+    '''Returns a latex string for the degree n Taylor polynomial of f about x=a.
+    If with_coefficients is True, returns (latex string, list of coefficients), see Taylor_coefficients,
+    so that e.g. the question and solution text can share one computation.'''
     # SAGE's built-in Taylor expansion is often simplified in annoying ways
-    x=var('x')
-    s=''
-    if a==0:
-        for i in range(n+1):
-            c = diff(f,x,i)(a)/factorial(i)
-            sc = re.sub('x','',latex(c*x))  # encapsulate c in brackets if necessary
-            if c!=0:
-                if i==0:
-                    if c==1:
-                        s=latex(1)
-                    elif c==-1:
-                        s=latex(-1)
-                    else:
-                        s=sc
-                elif i==1:
-                    if c==1:
-                        if len(s)>0:
-                            s=s+'+'
-                        s=s+'x'
-                    elif c==-1:
-                        s=s+'-x'
-                    elif c<0:
-                        s=s+sc+'x'
-                    else:
-                        if len(s)>0:
-                            s=s+'+'
-                        s=s+sc+'x'
-                else:
-                    if c==1:
-                        if len(s)>0:
-                            s=s+'+'
-                        s=s+'x^{'+latex(i)+'}'
-                    elif c==-1:
-                        s=s+'-x^{'+latex(i)+'}'
-                    else:
-                        if (len(s)>0) & (sc[0]!='-'):
-                            s=s+'+'
-                        s=s+sc+'x^{'+latex(i)+'}'
-    elif a>0:
-        for i in range(n+1):
-            c = diff(f,x,i)(a)/factorial(i)
-            sc = re.sub('x','',latex(c*x))  # encapsulate c in brackets if necessary
-            if c!=0:
-                if i==0:
-                    if c==1:
-                        s=latex(1)
-                    elif c==-1:
-                        s=latex(-1)
-                    else:
-                        s=sc
-                elif i==1:
-                    if c==1:
-                        if len(s)>0:
-                            s=s+'+'
-                        s=s+'(x-'+latex(a)+')'
-                    elif c==-1:
-                        s=s+'-(x-'+latex(a)+')'
-                    else:
-                        if (len(s)>0) & (sc[0]!='-'):
-                            s=s+'+'
-                        s=s+sc+'(x-'+latex(a)+')'
-                else:
-                    if c==1:
-                        if len(s)>0:
-                            s=s+'+'
-                        s=s+'(x-'+latex(a)+')^{'+latex(i)+'}'
-                    elif c==-1:
-                        s=s+'-(x-'+latex(a)+')^{'+latex(i)+'}'
-                    else:
-                        if (len(s)>0) & (sc[0]!='-'):
-                            s=s+'+'
-                        s=s+sc+'(x-'+latex(a)+')^{'+latex(i)+'}'
-    else: # a<0
-        for i in range(n+1):
-            c = diff(f,x,i)(a)/factorial(i)
-            sc = re.sub('x','',latex(c*x))  # encapsulate c in brackets if necessary
-            if c!=0:
-                if i==0:
-                    if c==1:
-                        s=latex(1)
-                    elif c==-1:
-                        s=latex(-1)
-                    else:
-                        s=sc
-                elif i==1:
-                    if c==1:
-                        if len(s)>0:
-                            s=s+'+'
-                        s=s+'(x+'+latex(-a)+')'
-                    elif c==-1:
-                        s=s+'-(x+'+latex(-a)+')'
-                    else:
-                        if (len(s)>0) & (sc[0]!='-'):
-                            s=s+'+'
-                        s=s+sc+'(x+'+latex(-a)+')'
-                else:
-                    if c==1:
-                        if len(s)>0:
-                            s=s+'+'
-                        s=s+'(x+'+latex(-a)+')^{'+latex(i)+'}'
-                    elif c==-1:
-                        s=s+'-(x+'+latex(-a)+')^{'+latex(i)+'}'
-                    else:
-                        if (len(s)>0) & (sc[0]!='-'):
-                            s=s+'+'
-                        s=s+sc+'(x+'+latex(-a)+')^{'+latex(i)+'}'
-    return(s)
+    coefficients = Taylor_coefficients(f, a, n)
+    s = Taylor_latex(coefficients, a)
+    if with_coefficients:
+        return s, coefficients
+    return s
 
 
 def scramble(A,c=3):
@@ -194,6 +173,51 @@ def tootrivial(A):
                 return true
     return false
 
+# Batched versions of scramble/scramble_full/tootrivial, for rejection sampling many integer matrices at once.
+# The row operations and checks run in NumPy on a (count, rows, cols) array; Sage matrices are only made
+# for the matrices that survive.
+
+def scramble_batch(A, count, c=3, full=False, rng=None):
+    '''Returns a NumPy array of shape (count, rows, cols) holding count independent copies of the integer matrix A
+    (a Sage matrix or a list of rows), each with the random row operations of scramble (or scramble_full if full=True)
+    performed on it. rng is a numpy.random.Generator, or a seed for one.'''
+    rng = np.random.default_rng(rng)
+    A = np.array([[int(a) for a in row] for row in A], dtype=np.int64)
+    rows = A.shape[0]
+    B = np.repeat(A[np.newaxis], count, axis=0)
+    K = rng.integers(-c, c+1, size=(count, rows, rows))
+    for i in range(rows):
+        for j in (range(rows) if full else range(i)):
+            if i != j:
+                B[:, i] += K[:, i, j, np.newaxis]*B[:, j]
+    return B
+
+def tootrivial_batch(B):
+    '''Returns a boolean NumPy array saying, for each matrix in the (count, rows, cols) array B,
+    whether it has two equal rows, a row equal to -(another row) or a row of zeroes (see tootrivial).'''
+    rows = B.shape[1]
+    trivial = (B == 0).all(axis=2).any(axis=1)
+    for i in range(rows):
+        for j in range(i):
+            trivial |= (B[:, i] == B[:, j]).all(axis=1) | (B[:, i] == -B[:, j]).all(axis=1)
+    return trivial
+
+def scrambled_matrices(A, count, c=3, full=False, seed=None, batch_size=None, max_batches=100):
+    '''Returns a list of count Sage matrices, obtained from the integer matrix A by the random row operations of
+    scramble (or scramble_full if full=True), none of which is tootrivial.
+    Candidates are generated and filtered batch_size (default 2*count) at a time, at most max_batches times;
+    raises ValueError if that does not produce enough of them.'''
+    base_ring = A.base_ring() if hasattr(A, 'base_ring') else ZZ
+    rng = np.random.default_rng(seed)
+    batch_size = batch_size or 2*count
+    survivors = []
+    for _ in range(max_batches):
+        B = scramble_batch(A, batch_size, c, full, rng)
+        survivors.extend(B[~tootrivial_batch(B)][:count-len(survivors)])
+        if len(survivors) >= count:
+            return [matrix(base_ring, M.tolist()) for M in survivors]
+    raise ValueError('Only found %d of %d non-trivial matrices in %d batches.' % (len(survivors), count, max_batches))
+
 def latexdet(A):
     """Returns a LaTeX string for the determinant of A using vertical bars."""
     s=latex(A).replace("\\left(","\\left|")
@@ -5,10 +5,16 @@ import re
 import xml.etree.ElementTree as ET
 import string
 import random
-from zipfile import ZipFile
+import hashlib
+import json
+from zipfile import ZipFile, ZipInfo
+from multiprocessing import Pool
+from contextlib import contextmanager
 from copy import deepcopy
-from shutil import copyfile
-from squid_utils import id_generator, get_img_filenames, get_filepaths, destroy
+from shutil import copyfile, copyfileobj
+from urllib.parse import unquote
+from squid_utils import (id_generator, IdentifierService, MediaRegistry, get_img_filenames, get_filepaths,
+    destroy)
 
 qti_template_string = r'''<?xml version="1.0" encoding="UTF-8"?>
 <questestinterop xmlns="http://www.imsglobal.org/xsd/ims_qtiasiv1p2" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.imsglobal.org/xsd/ims_qtiasiv1p2 http://www.imsglobal.org/xsd/ims_qtiasiv1p2p1.xsd">
@@ -82,6 +88,264 @@ qti_template_string = r'''<?xml version="1.0" encoding="UTF-8"?>
           </respcondition>
         </resprocessing>
       </item>
+      <item ident="g4b1e1d0c9a3f4e5b8c7d6e5f4a3b2c1d" title="Question 7">
+        <itemmetadata>
+          <qtimetadata>
+            <qtimetadatafield>
+              <fieldlabel>question_type</fieldlabel>
+              <fieldentry>numerical_question</fieldentry>
+            </qtimetadatafield>
+            <qtimetadatafield>
+              <fieldlabel>points_possible</fieldlabel>
+              <fieldentry>1.0</fieldentry>
+            </qtimetadatafield>
+            <qtimetadatafield>
+              <fieldlabel>original_answer_ids</fieldlabel>
+              <fieldentry>5209</fieldentry>
+            </qtimetadatafield>
+            <qtimetadatafield>
+              <fieldlabel>assessment_question_identifierref</fieldlabel>
+              <fieldentry>g9e8d7c6b5a4f3e2d1c0b9a8f7e6d5c4b</fieldentry>
+            </qtimetadatafield>
+          </qtimetadata>
+        </itemmetadata>
+        <presentation>
+          <material>
+            <mattext texttype="text/html">&lt;div&gt;&lt;p&gt;Solve this numerical question.&lt;/p&gt;&lt;/div&gt;</mattext>
+          </material>
+          <response_str ident="response1" rcardinality="Single">
+            <render_fib fibtype="Decimal">
+              <response_label ident="answer1"/>
+            </render_fib>
+          </response_str>
+        </presentation>
+        <resprocessing>
+          <outcomes>
+            <decvar maxvalue="100" minvalue="0" varname="SCORE" vartype="Decimal"/>
+          </outcomes>
+          <respcondition continue="No">
+            <conditionvar>
+              <or>
+                <varequal respident="response1">42.0</varequal>
+                <and>
+                  <vargte respident="response1">41.5</vargte>
+                  <varlte respident="response1">42.5</varlte>
+                </and>
+              </or>
+            </conditionvar>
+            <setvar action="Set" varname="SCORE">100</setvar>
+          </respcondition>
+        </resprocessing>
+      </item>
+      <item ident="g7c6b5a4f3e2d1c0b9a8f7e6d5c4b3a2f" title="Question 8">
+        <itemmetadata>
+          <qtimetadata>
+            <qtimetadatafield>
+              <fieldlabel>question_type</fieldlabel>
+              <fieldentry>multiple_answers_question</fieldentry>
+            </qtimetadatafield>
+            <qtimetadatafield>
+              <fieldlabel>points_possible</fieldlabel>
+              <fieldentry>1.0</fieldentry>
+            </qtimetadatafield>
+            <qtimetadatafield>
+              <fieldlabel>original_answer_ids</fieldlabel>
+              <fieldentry>2318,7745,6102</fieldentry>
+            </qtimetadatafield>
+            <qtimetadatafield>
+              <fieldlabel>assessment_question_identifierref</fieldlabel>
+              <fieldentry>g1a2b3c4d5e6f7a8b9c0d1e2f3a4b5c6d</fieldentry>
+            </qtimetadatafield>
+          </qtimetadata>
+        </itemmetadata>
+        <presentation>
+          <material>
+            <mattext texttype="text/html">&lt;div&gt;&lt;p&gt;Select all correct answers.&lt;/p&gt;&lt;/div&gt;</mattext>
+          </material>
+          <response_lid ident="response1" rcardinality="Multiple">
+            <render_choice>
+              <response_label ident="2318">
+                <material>
+                  <mattext texttype="text/plain">Correct answer</mattext>
+                </material>
+              </response_label>
+              <response_label ident="7745">
+                <material>
+                  <mattext texttype="text/plain">Wrong answer</mattext>
+                </material>
+              </response_label>
+              <response_label ident="6102">
+                <material>
+                  <mattext texttype="text/plain">Another correct answer</mattext>
+                </material>
+              </response_label>
+            </render_choice>
+          </response_lid>
+        </presentation>
+        <resprocessing>
+          <outcomes>
+            <decvar maxvalue="100" minvalue="0" varname="SCORE" vartype="Decimal"/>
+          </outcomes>
+          <respcondition continue="No">
+            <conditionvar>
+              <and>
+                <varequal respident="response1">2318</varequal>
+                <not>
+                  <varequal respident="response1">7745</varequal>
+                </not>
+                <varequal respident="response1">6102</varequal>
+              </and>
+            </conditionvar>
+            <setvar action="Set" varname="SCORE">100</setvar>
+          </respcondition>
+        </resprocessing>
+      </item>
+      <item ident="g2d3e4f5a6b7c8d9e0f1a2b3c4d5e6f7a" title="Question 9">
+        <itemmetadata>
+          <qtimetadata>
+            <qtimetadatafield>
+              <fieldlabel>question_type</fieldlabel>
+              <fieldentry>matching_question</fieldentry>
+            </qtimetadatafield>
+            <qtimetadatafield>
+              <fieldlabel>points_possible</fieldlabel>
+              <fieldentry>1.0</fieldentry>
+            </qtimetadatafield>
+            <qtimetadatafield>
+              <fieldlabel>original_answer_ids</fieldlabel>
+              <fieldentry>8821,3390</fieldentry>
+            </qtimetadatafield>
+            <qtimetadatafield>
+              <fieldlabel>assessment_question_identifierref</fieldlabel>
+              <fieldentry>g5f6a7b8c9d0e1f2a3b4c5d6e7f8a9b0c</fieldentry>
+            </qtimetadatafield>
+          </qtimetadata>
+        </itemmetadata>
+        <presentation>
+          <material>
+            <mattext texttype="text/html">&lt;div&gt;&lt;p&gt;Match the following.&lt;/p&gt;&lt;/div&gt;</mattext>
+          </material>
+          <response_lid ident="response_8821">
+            <material>
+              <mattext texttype="text/plain">Left 1</mattext>
+            </material>
+            <render_choice>
+              <response_label ident="4417">
+                <material>
+                  <mattext>Right 1</mattext>
+                </material>
+              </response_label>
+              <response_label ident="9063">
+                <material>
+                  <mattext>Right 2</mattext>
+                </material>
+              </response_label>
+            </render_choice>
+          </response_lid>
+          <response_lid ident="response_3390">
+            <material>
+              <mattext texttype="text/plain">Left 2</mattext>
+            </material>
+            <render_choice>
+              <response_label ident="4417">
+                <material>
+                  <mattext>Right 1</mattext>
+                </material>
+              </response_label>
+              <response_label ident="9063">
+                <material>
+                  <mattext>Right 2</mattext>
+                </material>
+              </response_label>
+            </render_choice>
+          </response_lid>
+        </presentation>
+        <resprocessing>
+          <outcomes>
+            <decvar maxvalue="100" minvalue="0" varname="SCORE" vartype="Decimal"/>
+          </outcomes>
+          <respcondition>
+            <conditionvar>
+              <varequal respident="response_8821">4417</varequal>
+            </conditionvar>
+            <setvar varname="SCORE" action="Add">50.00</setvar>
+          </respcondition>
+          <respcondition>
+            <conditionvar>
+              <varequal respident="response_3390">9063</varequal>
+            </conditionvar>
+            <setvar varname="SCORE" action="Add">50.00</setvar>
+          </respcondition>
+        </resprocessing>
+      </item>
+      <item ident="g8b9c0d1e2f3a4b5c6d7e8f9a0b1c2d3e" title="Question 10">
+        <itemmetadata>
+          <qtimetadata>
+            <qtimetadatafield>
+              <fieldlabel>question_type</fieldlabel>
+              <fieldentry>fill_in_multiple_blanks_question</fieldentry>
+            </qtimetadatafield>
+            <qtimetadatafield>
+              <fieldlabel>points_possible</fieldlabel>
+              <fieldentry>1.0</fieldentry>
+            </qtimetadatafield>
+            <qtimetadatafield>
+              <fieldlabel>original_answer_ids</fieldlabel>
+              <fieldentry>5531,1274</fieldentry>
+            </qtimetadatafield>
+            <qtimetadatafield>
+              <fieldlabel>assessment_question_identifierref</fieldlabel>
+              <fieldentry>g3c4d5e6f7a8b9c0d1e2f3a4b5c6d7e8f</fieldentry>
+            </qtimetadatafield>
+          </qtimetadata>
+        </itemmetadata>
+        <presentation>
+          <material>
+            <mattext texttype="text/html">&lt;div&gt;&lt;p&gt;Roses are [colour1], violets are [colour2].&lt;/p&gt;&lt;/div&gt;</mattext>
+          </material>
+          <response_lid ident="response_colour1">
+            <material>
+              <mattext>colour1</mattext>
+            </material>
+            <render_choice>
+              <response_label ident="5531" scoring_algorithm="TextInChoices">
+                <material>
+                  <mattext texttype="text/plain">red</mattext>
+                </material>
+              </response_label>
+            </render_choice>
+          </response_lid>
+          <response_lid ident="response_colour2">
+            <material>
+              <mattext>colour2</mattext>
+            </material>
+            <render_choice>
+              <response_label ident="1274" scoring_algorithm="TextInChoices">
+                <material>
+                  <mattext texttype="text/plain">blue</mattext>
+                </material>
+              </response_label>
+            </render_choice>
+          </response_lid>
+        </presentation>
+        <resprocessing>
+          <outcomes>
+            <decvar maxvalue="100" minvalue="0" varname="SCORE" vartype="Decimal"/>
+          </outcomes>
+          <respcondition>
+            <conditionvar>
+              <varequal respident="response_colour1">5531</varequal>
+            </conditionvar>
+            <setvar varname="SCORE" action="Add">50.00</setvar>
+          </respcondition>
+          <respcondition>
+            <conditionvar>
+              <varequal respident="response_colour2">1274</varequal>
+            </conditionvar>
+            <setvar varname="SCORE" action="Add">50.00</setvar>
+          </respcondition>
+        </resprocessing>
+      </item>
       <item ident="gaf668087013dd5ee0780860dacfdfbe0" title="Question 69">
         <itemmetadata>
           <qtimetadata>
@@ -159,6 +423,19 @@ manifelt_template_string = r'''<?xml version="1.0" encoding="UTF-8"?>
 </manifest>
 '''
 
+qti_media = None  # the MediaRegistry naming the images in "Uploaded Media", or None (see use_media)
+
+def use_media(media):
+    '''
+    Makes qti_img_tags refer to images by their names in the MediaRegistry media.
+    If media is None, images are referred to by their filename without the path.
+    Returns the registry used previously, so it can be restored.
+    '''
+    global qti_media
+    previous = qti_media
+    qti_media = media
+    return previous
+
 def qti_img_tags(s):
     '''
     Reformats any image tags in the string s with the right path for Canvas.
@@ -167,21 +444,62 @@ def qti_img_tags(s):
     imgs = get_img_filenames(s)
     new_s = s
     for fn in imgs:
-        new_s = new_s.replace(fn, '$IMS-CC-FILEBASE$/Uploaded%20Media/'+os.path.split(fn)[-1])
+        if qti_media is None:
+            name = os.path.split(fn)[-1]
+        else:
+            name = qti_media.add(fn)
+        new_s = new_s.replace(fn, '$IMS-CC-FILEBASE$/Uploaded%20Media/'+name)
     return new_s
 
+math_pattern = re.compile(r'\$(.*?)\$')  # compiled once, since qti_text is called for every answer
+
 def qti_text(s):
     '''Reformats the strings s to make it suitable for QTI'''
-    text = re.sub(r'\$(.*?)\$',r'\\(\1\\)',s)  # replace $?$ with \(?\) for MathJax
+    text = math_pattern.sub(r'\\(\1\\)',s)  # replace $?$ with \(?\) for MathJax
     text = qti_img_tags(text) # reformat image tags   ... will probably have to change a few more things...
     return text
 
+qti_ids = None  # the IdentifierService providing new identifiers, or None for random ones (see use_identifiers)
+
+def use_identifiers(ids):
+    '''
+    Makes all new QTI identifiers (and the shuffling of MCQ answers) come from the IdentifierService ids,
+    so that exports are reproducible. If ids is None, go back to random identifiers made with id_generator.
+    Returns the service used previously, so it can be restored.
+    '''
+    global qti_ids
+    previous = qti_ids
+    qti_ids = ids
+    return previous
+
+@contextmanager
+def qti_identifiers(seed=None):
+    '''
+    Context manager: inside the with-block, identifiers come from IdentifierService(seed).
+    If seed is None, nothing changes.
+    '''
+    if seed is None:
+        yield qti_ids
+        return
+    previous = use_identifiers(IdentifierService(seed))
+    try:
+        yield qti_ids
+    finally:
+        use_identifiers(previous)
+
+def qti_ident(chars='0123456789abcdef'):
+    '''Returns a new identifier: "g" followed by 30 characters from chars (or hex digits, if there is an
+    IdentifierService in use).'''
+    if qti_ids is None:
+        return 'g'+id_generator(size=30, chars=chars)
+    return 'g'+qti_ids.hex_id(30)
+
 def initialise_qti(title="Squid-based question pool", ident=None,  verbose=True):
     '''
     Initialise some globals, create a QTI assessment, return it in the form of an ElementTree.
 
     title : assessment title
-    ident : assessment identifier. If None (default) then a random one is created.
+    ident : assessment identifier. If None (default) then a new one is created with qti_ident.
     template_filement : the file used as template. Don't mess with this file unless you know what you're doing.
     verbose : if True (default), prints some messages.
 
@@ -191,6 +509,8 @@ def initialise_qti(title="Squid-based question pool", ident=None,  verbose=True)
     qti_root : the root element of qti_template
     qti_template_upload_question : Element
     qti_template_MCQ : Element
+    qti_templates : dict mapping each question_type in the template (e.g. 'numerical_question') to its Element
+    qti_builder_upload_question, qti_builder_MCQ, qti_builder_response : CompiledItem (see compile_item_templates)
     ns : string containing namespace for qti xml file
     nsp : as above, but wrapped in {}
     '''
@@ -201,6 +521,7 @@ def initialise_qti(title="Squid-based question pool", ident=None,  verbose=True)
     global qti_template_upload_question
     global qti_template_MCQ
     global qti_template_reponse
+    global qti_templates
     # First, we set the correct xml namespaces
     ns = "http://www.imsglobal.org/xsd/ims_qtiasiv1p2"
     nsp = '{'+ns+'}'
@@ -209,27 +530,160 @@ def initialise_qti(title="Squid-based question pool", ident=None,  verbose=True)
     # qti_template = ET.parse(template_filename) # Load the template from file
     qti_template = ET.ElementTree(ET.fromstring(qti_template_string))
     qti_root = qti_template.getroot() # the root of this tree
+    qti_templates = {}
     for item in qti_root.findall(".//"+nsp+"item"): # Next, we extract templates for questions
         for l in item.findall(".//"+nsp+"qtimetadatafield"):
             if l.find(nsp+'fieldlabel').text == 'question_type':
-                if l.find(nsp+'fieldentry').text == 'file_upload_question':
-                    if verbose: print(f'Got the file upload question: {item.get("title")}')
-                    qti_template_upload_question = deepcopy(item)
-                if l.find(nsp+'fieldentry').text == 'multiple_choice_question':
-                    if verbose: print(f'Got the multiple-choice question: {item.get("title")}')
-                    qti_template_MCQ = deepcopy(item)
+                question_type = l.find(nsp+'fieldentry').text
+                if verbose: print(f'Got the {question_type}: {item.get("title")}')
+                qti_templates[question_type] = deepcopy(item)
+    qti_template_upload_question = qti_templates['file_upload_question']
+    qti_template_MCQ = qti_templates['multiple_choice_question']
     # Now delete all items from the template, so what's left an empty assessment, ready for inserting new questions:
     for section in qti_root.findall(".//"+nsp+"section"):
         for item in section.findall(nsp+"item"):
             section.remove(item)
     qti_template_reponse = deepcopy(qti_template_MCQ.find(".//"+nsp+"response_label"))
+    compile_item_templates()
     assessment = qti_root.find(".//"+nsp+"assessment")
     assessment.set('title', title)
     if ident is None:
-        ident = 'g'+id_generator(size=30, chars='0123456789abcdef')
+        ident = qti_ident()
     assessment.set('ident', ident)
     return deepcopy(qti_template)
 
+class CompiledItem(object):
+    '''
+    A QTI element template, flattened once into a list of nodes so that fresh copies can be built
+    without deepcopy. Some nodes are marked as slots: build() returns direct references to them,
+    so they can be filled in without searching the new tree with find/findall.
+
+    template : the Element to compile (it is not modified)
+    slots : dict mapping slot names to (sub)elements of template
+    prune : list of subelements of template to leave out, together with their children
+    '''
+    def __init__(self, template, slots, prune=()):
+        pruned = {id(e) for e in prune}
+        index = {}
+        self.nodes = []  # list of (parent index, tag, attrib, text, tail), parents come first
+        def walk(e, parent):
+            index[id(e)] = len(self.nodes)
+            self.nodes.append((parent, e.tag, dict(e.attrib), e.text, e.tail))
+            me = index[id(e)]
+            for child in e:
+                if id(child) not in pruned:
+                    walk(child, me)
+        walk(template, -1)
+        self.slots = [(name, index[id(e)]) for name, e in slots.items()]
+
+    def build(self, parent_element=None):
+        '''Returns a new Element built from the template, and a dict of its slots.
+        If parent_element is given, the new Element is appended to it.'''
+        elements = []
+        for parent, tag, attrib, text, tail in self.nodes:
+            if parent < 0:
+                if parent_element is None:
+                    e = ET.Element(tag, attrib)
+                else:
+                    e = ET.SubElement(parent_element, tag, attrib)
+            else:
+                e = ET.SubElement(elements[parent], tag, attrib)
+            e.text = text
+            e.tail = tail
+            elements.append(e)
+        return elements[0], {name: elements[k] for name, k in self.slots}
+
+def qti_metadata_fields(R):
+    '''Returns a dict mapping fieldlabels to the fieldentry elements in the QTI question R.'''
+    return {l.find(nsp+'fieldlabel').text: l.find(nsp+'fieldentry') for l in R.findall(".//"+nsp+"qtimetadatafield")}
+
+def compile_item_templates():
+    '''
+    Compiles the item templates extracted by initialise_qti, creating the global variables
+
+    qti_builder_upload_question : CompiledItem with slots item, mattext, points, a_q_id
+    qti_builder_MCQ : CompiledItem with slots item, mattext, points, a_q_id, answer_ids, render_choice, varequal
+    qti_builder_response : CompiledItem with slots item, mattext
+    qti_builders : dict of CompiledItems for the other question types, and the parts that are repeated in them
+    '''
+    global qti_builder_upload_question
+    global qti_builder_MCQ
+    global qti_builder_response
+    R = qti_template_upload_question
+    fields = qti_metadata_fields(R)
+    qti_builder_upload_question = CompiledItem(R, {'item': R,
+                                                   'mattext': R.find(".//"+nsp+"mattext"),
+                                                   'points': fields['points_possible'],
+                                                   'a_q_id': fields['assessment_question_identifierref']})
+    R = qti_template_MCQ
+    fields = qti_metadata_fields(R)
+    render_choice = R.find(".//"+nsp+"render_choice")
+    qti_builder_MCQ = CompiledItem(R, {'item': R,
+                                       'mattext': R.find(".//"+nsp+"mattext"),
+                                       'points': fields['points_possible'],
+                                       'a_q_id': fields['assessment_question_identifierref'],
+                                       'answer_ids': fields['original_answer_ids'],
+                                       'render_choice': render_choice,
+                                       'varequal': R.find(".//"+nsp+"varequal")},
+                                   prune=render_choice.findall(nsp+"response_label"))
+    R = qti_template_reponse
+    qti_builder_response = CompiledItem(R, {'item': R, 'mattext': R.find(".//"+nsp+"mattext")})
+
+    global qti_builders
+    qti_builders = {}
+    R = qti_templates['numerical_question']
+    fields = qti_metadata_fields(R)
+    qti_builders['numerical'] = CompiledItem(R, {'item': R,
+                                                 'mattext': R.find(".//"+nsp+"mattext"),
+                                                 'points': fields['points_possible'],
+                                                 'a_q_id': fields['assessment_question_identifierref'],
+                                                 'answer_ids': fields['original_answer_ids'],
+                                                 'varequal': R.find(".//"+nsp+"varequal"),
+                                                 'vargte': R.find(".//"+nsp+"vargte"),
+                                                 'varlte': R.find(".//"+nsp+"varlte")})
+    R = qti_templates['multiple_answers_question']
+    fields = qti_metadata_fields(R)
+    render_choice = R.find(".//"+nsp+"render_choice")
+    condition = R.find(".//"+nsp+"conditionvar/"+nsp+"and")
+    qti_builders['MA'] = CompiledItem(R, {'item': R,
+                                          'mattext': R.find(".//"+nsp+"mattext"),
+                                          'points': fields['points_possible'],
+                                          'a_q_id': fields['assessment_question_identifierref'],
+                                          'answer_ids': fields['original_answer_ids'],
+                                          'render_choice': render_choice,
+                                          'and': condition},
+                                      prune=render_choice.findall(nsp+"response_label")+list(condition))
+    qti_builders['MA varequal'] = CompiledItem(condition[0], {'item': condition[0]})
+    qti_builders['MA not'] = CompiledItem(condition[1], {'item': condition[1], 'varequal': condition[1][0]})
+    # Matching and fill-in-multiple-blanks questions have one response_lid (with its own choices) and one or more
+    # respconditions for each thing to match, or blank to fill in:
+    for name, question_type in [('matching', 'matching_question'), ('FIB', 'fill_in_multiple_blanks_question')]:
+        R = qti_templates[question_type]
+        fields = qti_metadata_fields(R)
+        presentation = R.find(nsp+"presentation")
+        resprocessing = R.find(nsp+"resprocessing")
+        lids = presentation.findall(nsp+"response_lid")
+        conditions = resprocessing.findall(nsp+"respcondition")
+        qti_builders[name] = CompiledItem(R, {'item': R,
+                                              'mattext': R.find(".//"+nsp+"mattext"),
+                                              'points': fields['points_possible'],
+                                              'a_q_id': fields['assessment_question_identifierref'],
+                                              'answer_ids': fields['original_answer_ids'],
+                                              'presentation': presentation,
+                                              'resprocessing': resprocessing},
+                                          prune=lids+conditions)
+        lid = lids[0]
+        labels = lid.findall(".//"+nsp+"response_label")
+        qti_builders[name+' lid'] = CompiledItem(lid, {'item': lid,
+                                                       'mattext': lid.find(nsp+"material/"+nsp+"mattext"),
+                                                       'render_choice': lid.find(nsp+"render_choice")},
+                                                 prune=labels)
+        qti_builders[name+' label'] = CompiledItem(labels[0], {'item': labels[0],
+                                                               'mattext': labels[0].find(".//"+nsp+"mattext")})
+        qti_builders[name+' condition'] = CompiledItem(conditions[0], {'item': conditions[0],
+                                                                       'varequal': conditions[0].find(".//"+nsp+"varequal"),
+                                                                       'setvar': conditions[0].find(nsp+"setvar")})
+
 def qti_set_question_text(R, text):
     '''Given qti question R, changes the question text to text.'''
     R.find(".//"+nsp+"mattext").text = text
@@ -250,6 +704,35 @@ def qti_file_upload_question_new():
     '''Returns a fresh copy of the file upload template'''
     return deepcopy(qti_template_upload_question)
 
+def qti_new_item(builder, text, a_q_id, points, ident, title):
+    '''Builds a new question from the CompiledItem builder and fills in the slots common to all question types.
+    a_q_id and ident will be generated if they are None. Returns the question and its slots.'''
+    Q, slots = builder.build() # create a new instance
+    Q.set('title',title)
+    if ident is None:
+        ident = qti_ident()
+    Q.set('ident', ident)
+    slots['mattext'].text = text
+    if a_q_id is None:
+        a_q_id = qti_ident(chars=string.ascii_lowercase + string.digits)
+    slots['a_q_id'].text = a_q_id
+    slots['points'].text = str(points)
+    return Q, slots
+
+def qti_answer_ids(n):
+    '''Returns a list of n distinct answer identifiers for a new question.
+    They are only unique within the question, unless there is an IdentifierService in use.'''
+    if qti_ids is None:
+        return [str(k) for k in random.sample(range(1000, 10000), n)]
+    return qti_ids.answer_ids(n)
+
+def qti_random():
+    '''Returns the random number generator to shuffle answers with: the random module, or the generator for the
+    current item of the IdentifierService in use.'''
+    if qti_ids is None:
+        return random
+    return qti_ids.random
+
 def ET_file_upload_question(text='Question text',
                            a_q_id=None,
                            points=3,
@@ -257,16 +740,7 @@ def ET_file_upload_question(text='Question text',
                            title='Question 1'):
     '''Returns an ElementTree element containing a QTI file upload question. a_q_id and ident will be
     randomly generated unless given specific values'''
-    Q = qti_file_upload_question_new() # create a new instance
-    Q.set('title',title)
-    if ident is None:
-        ident = 'g'+id_generator(size=30, chars='0123456789abcdef')
-    Q.set('ident', ident)
-    qti_set_question_text(Q, text)
-    if a_q_id is None:
-        a_q_id = 'g'+id_generator(30)
-    qti_set_identifier(Q, a_q_id)
-    qti_set_points(Q, points)
+    Q, slots = qti_new_item(qti_builder_upload_question, text, a_q_id, points, ident, title)
     return Q
 
 def qti_MCQ_new():
@@ -288,54 +762,162 @@ def ET_MCQ(text='Question text',
 
     To Do: randomise the answers (so you don't have to do so in Canvas, and "None of the above" is always last.)
     '''
-    Q = qti_MCQ_new() # create a new instance
-    Q.set('title',title)
-    if ident is None:
-        ident = 'g'+id_generator(size=30, chars='0123456789abcdef')
-    Q.set('ident', ident)
-    qti_set_question_text(Q, text)
-    if a_q_id is None:
-        a_q_id = 'g'+id_generator(30)
-    qti_set_identifier(Q, a_q_id)
-    qti_set_points(Q, points)
+    Q, slots = qti_new_item(qti_builder_MCQ, text, a_q_id, points, ident, title)
     answers = [answer]+wrong_answers
     if none_of_these:
         answers.append('None of the others')
     # Now generate the original_answer_ids. I'm not sure what happens if there is a collision of these
-    # among different questions... but at least make sure no collisions happen within a question
+    # among different questions... but at least make sure no collisions happen within a question.
+    # An IdentifierService makes them unique within the whole export.
     options = len(answers)
-    answer_ids = list({id_generator(size=1, chars='123456789')+id_generator(size=3, chars='0123456789')
-                       for k in range(options+2)})[:options]
-    # write the list of answer_ids to the right place
-    for l in Q.findall(".//"+nsp+"qtimetadatafield"):
-        if l.find(nsp+'fieldlabel').text == 'original_answer_ids':
-            l.find(nsp+'fieldentry').text = ','.join(answer_ids)
-    # delete response_labels from template:
-    render_choice = Q.find(".//"+nsp+"render_choice")
-    for response_label in render_choice.findall(nsp+"response_label"):
-        render_choice.remove(response_label)
-
+    answer_ids = qti_answer_ids(options)
+    slots['answer_ids'].text = ','.join(answer_ids)
+    # the compiled template comes without response_labels, so we can insert the choices straight away
+    render_choice = slots['render_choice']
     ordering = list(range(options))
     if shuffle_answers:
         if none_of_these:   # don't shuffle the last one around
-            ordering = random.sample(ordering[:-1], len(ordering[:-1]))+[ordering[-1]]
+            ordering = qti_random().sample(ordering[:-1], len(ordering[:-1]))+[ordering[-1]]
         else:  # shuffle all of them
-            ordering = random.sample(ordering, len(ordering))
+            ordering = qti_random().sample(ordering, len(ordering))
     # now insert the various choices
     for k in ordering:
-        response = deepcopy(qti_template_reponse)
+        response, response_slots = qti_builder_response.build(render_choice)
         response.set('ident', answer_ids[k])
-        qti_set_question_text(response, answers[k])
-        render_choice.append(response)
-    #
-    # for k, text in enumerate(answers):
-    #     response = deepcopy(qti_template_reponse)
-    #     response.set('ident', answer_ids[k])
-    #     qti_set_question_text(response, text)
-    #     render_choice.append(response)
+        response_slots['mattext'].text = answers[k]
     # Finally, tell it which response is the correct one
-    varequal = Q.find(".//"+nsp+"varequal")
-    varequal.text = answer_ids[0]
+    slots['varequal'].text = answer_ids[0]
+    return Q
+
+def ET_numerical_question(text='Question text',
+                          a_q_id=None,
+                          points=1,
+                          ident=None,
+                          title='Question 1',
+                          answer=42,
+                          tolerance=0):
+    '''
+    Returns an ElementTree element containing a QTI numerical question. a_q_id and ident will be
+    randomly generated unless given specific values.
+    Any response between answer-tolerance and answer+tolerance is marked correct.
+    '''
+    Q, slots = qti_new_item(qti_builders['numerical'], text, a_q_id, points, ident, title)
+    slots['answer_ids'].text = qti_answer_ids(1)[0]
+    answer = float(answer)
+    tolerance = abs(float(tolerance))
+    slots['varequal'].text = str(answer)
+    slots['vargte'].text = str(answer-tolerance)
+    slots['varlte'].text = str(answer+tolerance)
+    return Q
+
+def ET_multiple_answers_question(text='Question text',
+                                 a_q_id=None,
+                                 points=1,
+                                 ident=None,
+                                 title='Question 1',
+                                 answers=['Correct answer', 'Another correct answer'],
+                                 wrong_answers=['Wrong answer'],
+                                 shuffle_answers=True):
+    '''
+    Returns an ElementTree element containing a QTI multiple-answers question, i.e. the student has to select
+    all of the answers and none of the wrong_answers. a_q_id and ident will be randomly generated unless given
+    specific values.
+    '''
+    Q, slots = qti_new_item(qti_builders['MA'], text, a_q_id, points, ident, title)
+    choices = answers+wrong_answers
+    options = len(choices)
+    answer_ids = qti_answer_ids(options)
+    slots['answer_ids'].text = ','.join(answer_ids)
+    ordering = list(range(options))
+    if shuffle_answers:
+        ordering = qti_random().sample(ordering, options)
+    for k in ordering:
+        response, response_slots = qti_builder_response.build(slots['render_choice'])
+        response.set('ident', answer_ids[k])
+        response_slots['mattext'].text = choices[k]
+    # The response is correct if it selects exactly the right answers:
+    for k in range(options):
+        if k < len(answers):
+            condition, condition_slots = qti_builders['MA varequal'].build(slots['and'])
+            condition.text = answer_ids[k]
+        else:
+            condition, condition_slots = qti_builders['MA not'].build(slots['and'])
+            condition_slots['varequal'].text = answer_ids[k]
+    return Q
+
+def qti_insert_lid(slots, name, lid_ident, label, choice_ids, choices, correct_ids, score):
+    '''
+    Inserts a response_lid into the matching or fill-in-multiple-blanks question with the given slots, i.e.
+    one of the things to be matched, or one of the blanks to be filled in.
+    name selects the templates: either 'matching' or 'FIB'.
+    lid_ident is the identifier of the response_lid, label is its text, choices are the possible responses
+    (with identifiers choice_ids), and each of the correct_ids adds score to the SCORE.
+    '''
+    lid, lid_slots = qti_builders[name+' lid'].build(slots['presentation'])
+    lid.set('ident', lid_ident)
+    lid_slots['mattext'].text = label
+    for choice_id, choice in zip(choice_ids, choices):
+        response, response_slots = qti_builders[name+' label'].build(lid_slots['render_choice'])
+        response.set('ident', choice_id)
+        response_slots['mattext'].text = choice
+    for correct_id in correct_ids:
+        condition, condition_slots = qti_builders[name+' condition'].build(slots['resprocessing'])
+        condition_slots['varequal'].set('respident', lid_ident)
+        condition_slots['varequal'].text = correct_id
+        condition_slots['setvar'].text = score
+
+def ET_matching_question(text='Question text',
+                         a_q_id=None,
+                         points=1,
+                         ident=None,
+                         title='Question 1',
+                         pairs=[('Left 1', 'Right 1'), ('Left 2', 'Right 2')],
+                         distractors=[],
+                         shuffle_answers=True):
+    '''
+    Returns an ElementTree element containing a QTI matching question: for each pair (left, right) in pairs,
+    the student has to choose right from a list of all the rights (plus the distractors).
+    a_q_id and ident will be randomly generated unless given specific values.
+    '''
+    Q, slots = qti_new_item(qti_builders['matching'], text, a_q_id, points, ident, title)
+    matches = list(dict.fromkeys([right for left, right in pairs]+distractors))  # each match offered once
+    answer_ids = qti_answer_ids(len(pairs)+len(matches))
+    left_ids = answer_ids[:len(pairs)]
+    match_ids = answer_ids[len(pairs):]
+    slots['answer_ids'].text = ','.join(left_ids)
+    ordering = list(range(len(matches)))
+    if shuffle_answers:
+        ordering = qti_random().sample(ordering, len(matches))
+    choice_ids = [match_ids[k] for k in ordering]
+    choices = [matches[k] for k in ordering]
+    score = f'{100/len(pairs):.2f}'
+    for left_id, (left, right) in zip(left_ids, pairs):
+        qti_insert_lid(slots, 'matching', 'response_'+left_id, left, choice_ids, choices,
+                       [match_ids[matches.index(right)]], score)
+    return Q
+
+def ET_fill_in_multiple_blanks_question(text='Roses are [colour1], violets are [colour2].',
+                                        a_q_id=None,
+                                        points=1,
+                                        ident=None,
+                                        title='Question 1',
+                                        blanks={'colour1': ['red'], 'colour2': ['blue']}):
+    '''
+    Returns an ElementTree element containing a QTI fill-in-multiple-blanks question.
+    blanks is a dict mapping the name of each blank, which appears as [name] in text, to the list of
+    answers accepted for it (or a single answer).
+    a_q_id and ident will be randomly generated unless given specific values.
+    '''
+    Q, slots = qti_new_item(qti_builders['FIB'], text, a_q_id, points, ident, title)
+    blanks = {name: [answers] if isinstance(answers, str) else list(answers) for name, answers in blanks.items()}
+    answer_ids = qti_answer_ids(sum(len(answers) for answers in blanks.values()))
+    slots['answer_ids'].text = ','.join(answer_ids)
+    score = f'{100/len(blanks):.2f}'
+    k = 0
+    for name, answers in blanks.items():
+        ids = answer_ids[k:k+len(answers)]
+        k += len(answers)
+        qti_insert_lid(slots, 'FIB', 'response_'+name, name, ids, answers, ids, score)
     return Q
 
 def qti_insert_question(Q, T=None):
@@ -372,19 +954,191 @@ def save_qti(filename, T=None, verbose=False, zip_it=True):
         if verbose:
             print(f'Created {filename}.zip - You can upload this file to Canvas.')
 
-def write_manifest(subdir, ident=None):
-    '''Writes the imsmanifest.xml file into the directory subdir.
-    If ident is None (default), then we obtain the assessment identifier by looking at the subdirectory'''
+def qti_item_xml(Q):
+    '''Returns the QTI question Q (an Element) serialised as a UTF-8 encoded bytes object, ready to be
+    written inside the section of an assessment. The namespace declaration is left to the enclosing document.'''
+    xml = ET.tostring(Q, encoding='unicode')
+    return xml.replace(' xmlns="'+ns+'"', '', 1).encode('UTF-8')
 
-    if ident is None:   # look at the directory to see what the identifier is
-        directorylist = os.listdir(subdir)
+def qti_stream_parts(title="Squid-based question pool", ident=None):
+    '''
+    Returns a pair (head, tail) of bytes objects, which are the parts of an empty QTI assessment before and
+    after the (missing) items. Writing head, then any number of serialised items, then tail produces the
+    same file as inserting the items into an ElementTree and writing it out.
+    '''
+    T = initialise_qti(title=title, ident=ident, verbose=False)
+    section = T.getroot().find(".//"+nsp+"section")
+    indent = section.text
+    section.text = 'SQUID_ITEMS_GO_HERE'
+    head, tail = ET.tostring(T.getroot(), encoding='UTF-8', xml_declaration=True).split(b'SQUID_ITEMS_GO_HERE')
+    return head+indent.encode('UTF-8'), tail
+
+class QtiCache(object):
+    '''
+    A persistent cache of rendered QTI items, stored as one file per item in the directory path.
+    Items are keyed by a hash of everything that goes into them, so when a few questions in a large pool
+    change, only those have to be rendered again.
+
+    The key covers the question type, question text, answers, marks, variant number (hence the title),
+    the number of the item in the export, the seed of the IdentifierService in use, if any, and the
+    names of the images in the MediaRegistry in use, if any (these change with the contents of the images).
+    If you write a question class whose qti() method depends on anything else, clear() the cache after changing it.
+
+    The cache also keeps the names of the images of the last export (see MediaRegistry.known) in media.json,
+    so images that haven't changed since aren't read and hashed again.
+    '''
+    def __init__(self, path='Squid_qti_cache'):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, Q, item):
+        '''Returns the key for question Q as item number item of an export.'''
+        seed = '' if qti_ids is None else qti_ids.seed
+        parts = [type(Q).__name__, Q.question_type, Q.q_text(), str(getattr(Q, 'marks', '')),
+                 str(Q.variant_number), str(item), seed]
+        if hasattr(Q, 'answer_texts'):
+            parts = parts + [str(a) for a in Q.answer_texts()]
+        if qti_media is not None:  # the stored names of images change with their contents
+            parts = parts + qti_media.add_question(Q)
+        return hashlib.sha256('\0'.join(parts).encode('UTF-8')).hexdigest()
+
+    def get(self, key):
+        '''Returns the cached item for key (as bytes), or None.'''
         try:
-            directorylist.remove('Uploaded Media')
-        except ValueError:
-            pass
-        ident = directorylist[0]
+            with open(os.path.join(self.path, key+'.xml'), 'rb') as f:
+                xml = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return xml
+
+    def put(self, key, xml):
+        '''Stores the item xml (bytes) under key.'''
+        filename = os.path.join(self.path, key+'.xml')
+        with open(filename+f'.{os.getpid()}.tmp', 'wb') as f:  # write, then rename, so readers never see half a file
+            f.write(xml)
+        os.replace(filename+f'.{os.getpid()}.tmp', filename)
+
+    def media_names(self):
+        '''Returns the names of the images of the last export, for MediaRegistry(known=...).'''
+        try:
+            with open(os.path.join(self.path, 'media.json'), encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def put_media_names(self, known, names):
+        '''Stores the names of the images of an export: the entries of the known dict of its MediaRegistry
+        for the stored names in names (so images no longer used are forgotten).'''
+        filename = os.path.join(self.path, 'media.json')
+        with open(filename+f'.{os.getpid()}.tmp', 'w', encoding='utf-8') as f:
+            json.dump({stamp: name for stamp, name in known.items() if name in names}, f)
+        os.replace(filename+f'.{os.getpid()}.tmp', filename)
+
+    def clear(self):
+        '''Deletes all cached items.'''
+        for filename in os.listdir(self.path):
+            os.remove(os.path.join(self.path, filename))
+
+def cached_qti_item_xml(Q, item=0, cache=None):
+    '''Returns qti_item_xml(Q.qti()), taking it from the QtiCache cache if Q has been rendered before as item
+    number item. If cache is None, just renders Q.'''
+    if cache is None:
+        return qti_item_xml(Q.qti())
+    key = cache.key(Q, item)
+    xml = cache.get(key)
+    if xml is None:
+        xml = qti_item_xml(Q.qti())
+        cache.put(key, xml)
+    return xml
 
-    # Now, register some namespaces and load the manifest templates
+def _init_qti_worker(known_media):
+    '''Initialises a worker process of render_qti_items. If known_media is not None, images are named by a
+    MediaRegistry (knowing the images in known_media, see MediaRegistry.known), as in the parent process.'''
+    initialise_qti(verbose=False)
+    use_media(None if known_media is None else MediaRegistry(known_media))
+
+def _render_qti_item(job):
+    '''Renders a single question in a worker process of render_qti_items. job is a tuple (Q, seed, item, cache).'''
+    Q, seed, item, cache = job
+    ids = IdentifierService(seed)
+    ids.start_item(item)
+    use_identifiers(ids)
+    random.seed(f'{seed}:{item}')  # in case Q.qti() uses the random module itself
+    return cached_qti_item_xml(Q, item, cache)
+
+def render_qti_items(questions, workers=None, chunksize=16, cache=None):
+    '''
+    Generator yielding the serialised QTI items (see qti_item_xml) of the Squid questions in the iterable questions,
+    in order. If an IdentifierService is in use, each question gets a new item number from it.
+    If workers is None (default), the questions are rendered one by one in this process.
+    Otherwise they are rendered by a pool of workers processes, chunksize questions at a time.
+    Each worker takes its identifiers from an IdentifierService with the same seed and item number as here
+    (a random seed if none is in use), so the output doesn't depend on the number of workers, and is the same
+    as rendering serially with that seed. Workers name images by their contents if a MediaRegistry is in use here
+    (the names only depend on the contents), and by their filenames otherwise, just like here.
+    Note that the pool consumes questions ahead of the results, so in that case they all end up in memory.
+    cache : a QtiCache (or the name of its directory); questions found in it are not rendered again.
+    '''
+    if isinstance(cache, str):
+        cache = QtiCache(cache)
+    if workers is None:
+        try:
+            for k, Q in enumerate(questions, 1):
+                if qti_ids is not None:
+                    k = qti_ids.new_item()
+                    qti_ids.start_item(k)
+                yield cached_qti_item_xml(Q, k, cache)
+        finally:
+            if qti_ids is not None:
+                qti_ids.start_item(0)
+        return
+    ids = qti_ids if qti_ids is not None else IdentifierService()
+    jobs = ((Q, ids.seed, ids.new_item(), cache) for Q in questions)
+    with Pool(workers, initializer=_init_qti_worker, initargs=(None if qti_media is None else qti_media.known,)) as pool:
+        for item in pool.imap(_render_qti_item, jobs, chunksize):
+            yield item
+
+def write_qti_stream(f, questions, title="Squid-based question pool", ident=None, make_variant_numbers=True,
+                     workers=None, seed=None, cache=None):
+    '''
+    Writes a QTI assessment containing the Squid questions in the iterable questions to the file object f,
+    which must be opened for writing in binary mode.
+    Unlike qti_insert_question and save_qti, this never holds the whole assessment in memory: each question
+    is rendered with Q.qti(), written to f and discarded before the next one is requested, so questions
+    can be a generator producing variants on the fly.
+    ident : assessment identifier. If None (default) then a new one is created.
+    If make_variant_numbers is True (default), the questions are numbered 1, 2, 3, ... as they are written.
+    workers : if not None, render the questions in a pool of this many processes (see render_qti_items).
+    seed : if not None, identifiers come from IdentifierService(seed), so the output is reproducible.
+    cache : if not None, a QtiCache (or the name of its directory) of previously rendered questions.
+    Returns the number of questions written.
+    '''
+    count = 0
+    def numbered():
+        nonlocal count
+        for Q in questions:
+            count += 1
+            if make_variant_numbers:
+                Q.update_variant_number(count)
+            yield Q
+    with qti_identifiers(seed):
+        head, tail = qti_stream_parts(title=title, ident=ident)
+        f.write(head)
+        for item in render_qti_items(numbered(), workers=workers, cache=cache):
+            f.write(item)
+        f.write(tail)
+    return count
+
+def manifest_xml(ident, media=()):
+    '''Returns the contents of imsmanifest.xml (as bytes) for the assessment with identifier ident,
+    and the list media of image filenames in "Uploaded Media".
+    ident may also be a list of identifiers, for a package containing several assessments.'''
+
+    # Register some namespaces and load the manifest templates
     # manifest_template_filename = 'imsmanifest_template.xml'
     ns = "http://www.imsglobal.org/xsd/imsccv1p1/imscp_v1p1"
     nsp = '{'+ns+'}'
@@ -419,7 +1173,7 @@ def write_manifest(subdir, ident=None):
         '''Returns the resource xml node for the image [filename].
         It gets an identifier imgident. If this is None (default), we invent a random one.'''
         if imgident is None:
-            imgident = 'g'+id_generator(size=30, chars='0123456789abcdef')
+            imgident = qti_ident()
         r = new_resource()
         r.set('identifier', imgident)
         r.set('type', "webcontent")
@@ -437,13 +1191,97 @@ def write_manifest(subdir, ident=None):
         return T
 
     # Finally, let's put everything together
-    insert_resource(resource_xml(ident))
+    if isinstance(ident, str):
+        ident = [ident]
+    for assessment_ident in ident:
+        insert_resource(resource_xml(assessment_ident))
+    for imgfile in media:
+        insert_resource(resource_img(imgfile))
+    return ET.tostring(manifest_template.getroot())
+
+def write_manifest(subdir, ident=None):
+    '''Writes the imsmanifest.xml file into the directory subdir.
+    If ident is None (default), then we obtain the assessment identifier by looking at the subdirectory'''
+
+    if ident is None:   # look at the directory to see what the identifier is
+        directorylist = os.listdir(subdir)
+        try:
+            directorylist.remove('Uploaded Media')
+        except ValueError:
+            pass
+        ident = directorylist[0]
     try:
-        for imgfile in os.listdir(os.path.join(subdir, "Uploaded Media")):
-            insert_resource(resource_img(imgfile))
+        media = sorted(os.listdir(os.path.join(subdir, "Uploaded Media")))
     except FileNotFoundError:
-        pass
-    manifest_template.write(os.path.join(subdir,'imsmanifest.xml'))
+        media = []
+    with open(os.path.join(subdir,'imsmanifest.xml'), 'wb') as f:
+        f.write(manifest_xml(ident, media))
+
+def write_qti_package(zipobj, quizzes, idents=None, make_variant_numbers=True, workers=None, seed=None, cache=None):
+    '''
+    Writes a complete Canvas QTI package containing several assessments into the open ZipFile zipobj:
+    one xml file per assessment, the images in "Uploaded Media" and imsmanifest.xml.
+    Everything is streamed straight into the zip file, so nothing is staged on disk.
+    quizzes : dict mapping quiz titles to lists (or other iterables) of Squid questions
+    idents : list of assessment identifiers, one for each quiz. If None (default) then new ones are created.
+    workers : if not None, render the questions in a pool of this many processes (see render_qti_items).
+    seed : if not None, identifiers come from IdentifierService(seed) and the zip entries get a fixed
+           timestamp, so that exporting the same questions again gives an identical file.
+           A seed also keeps identifiers unique across the quizzes when a cache is used.
+    cache : if not None, a QtiCache (or the name of its directory) of previously rendered questions.
+    Images are collected in a MediaRegistry, so each distinct image is stored only once (even if several
+    quizzes use it) under a name derived from its contents. The manifest is built in one go at the end.
+    Returns the list of assessment identifiers.
+    '''
+    if isinstance(cache, str):
+        cache = QtiCache(cache)
+    media = MediaRegistry(None if cache is None else cache.media_names())
+    def questions(L):
+        for Q in L:    # register the images used in questions in L, as they go past
+            media.add_question(Q)
+            yield Q
+
+    def entry(name):
+        if seed is None:
+            return name
+        return ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+
+    previous_media = use_media(media)
+    try:
+        with qti_identifiers(seed):
+            if idents is None:
+                idents = [None for title in quizzes]
+            idents = list(idents)
+            for k, (title, L) in enumerate(quizzes.items()):
+                if idents[k] is None:
+                    idents[k] = qti_ident()
+                with zipobj.open(entry(idents[k]+'/'+idents[k]+'.xml'), 'w') as f:
+                    write_qti_stream(f, questions(L), title=title, ident=idents[k],
+                                     make_variant_numbers=make_variant_numbers, workers=workers, cache=cache)
+            for name, img in media.blobs.items():
+                if seed is None:
+                    zipobj.write(img, 'Uploaded Media/'+name)
+                else:
+                    with open(img, 'rb') as f:
+                        zipobj.writestr(entry('Uploaded Media/'+name), f.read())
+            zipobj.writestr(entry('imsmanifest.xml'), manifest_xml(idents, media.blobs))
+        if cache is not None:
+            cache.put_media_names(media.known, media.blobs)
+    finally:
+        use_media(previous_media)
+    return idents
+
+def write_qti_zip(zipobj, L, title='Squid-made question pool', ident=None, make_variant_numbers=True, workers=None,
+                  seed=None, cache=None):
+    '''
+    Writes a complete Canvas QTI package for the Squid questions in L into the open ZipFile zipobj:
+    the assessment xml file, the images in "Uploaded Media" and imsmanifest.xml.
+    This is write_qti_package with a single quiz; see there for the other parameters.
+    ident : assessment identifier. If None (default) then a new one is created.
+    Returns ident.
+    '''
+    return write_qti_package(zipobj, {title: L}, idents=[ident], make_variant_numbers=make_variant_numbers,
+                             workers=workers, seed=seed, cache=cache)[0]
 
 def SaveToQtiFile(L,
         zip_filename='upload_me_to_canvas',
@@ -452,19 +1290,36 @@ def SaveToQtiFile(L,
         overwrite=False,
         clean_up=True,
         make_variant_numbers=True,
-        verbose=False):
+        verbose=False,
+        workers=None,
+        seed=None,
+        cache=None):
     '''
     Saves a list L of Squid questions to a qti file for uploading to canvas.
     filename should *exclude* the file extension.
-    subdir is the subdirectory into which the various files will be written.
+    Everything is written straight into the zip file (see write_qti_zip), without copying the images twice.
+    If clean_up is False (default is True), the various files are also kept in the subdirectory subdir,
+    unless subdir is None.
     If overwrite is True (default is False): delete existing zip_filename and subdir first.
-    If clean_up is True (default is True): delete subdir afterwards.'''
+    The assessment is written with write_qti_stream, so L may also be a generator of questions.
+    If workers is not None, the questions are rendered in parallel by that many processes.
+    If seed is not None, all identifiers are derived from it (see IdentifierService), so saving the same
+    questions again with the same seed gives the same files.
+    If cache is not None, it should be a QtiCache (or the name of its directory): questions which haven't
+    changed since they were last saved are then taken from the cache instead of being rendered again.'''
     if os.path.exists(zip_filename+'.zip'):
         if overwrite:
             os.remove(zip_filename+'.zip')
         else:
             print(f'*** {zip_filename}.zip already exists! Use SaveToQtiFile(L, overwrite=True) to force deleting it first.')
             return
+    if subdir is None or clean_up:
+        with ZipFile(zip_filename+'.zip', 'w') as zipobj:
+            write_qti_zip(zipobj, L, title=title, make_variant_numbers=make_variant_numbers, workers=workers,
+                          seed=seed, cache=cache)
+        if verbose:
+            print(f'Created {zip_filename}.zip. You can upload it to canvas.')
+        return
     if os.path.exists(subdir):
         if overwrite:
             destroy(subdir)
@@ -474,46 +1329,271 @@ def SaveToQtiFile(L,
             return
     else:
         os.mkdir(subdir)
-    images = []
-    for Q in L:    # Populate a list of all image filenames used in questions in L
-        images = images + get_img_filenames(Q.q_text())
-        if Q.question_type == 'MCQ':
-            images = images + get_img_filenames(Q.answer)
-            for wa in Q.wrong_answers:
-                images = images + get_img_filenames(wa)
-
-    ident = 'g'+id_generator(size=30, chars='0123456789abcdef')  # the assessment identifier, also needed for filenames
-    T = initialise_qti(title=title, ident=ident, verbose=False)
-    if make_variant_numbers:
-        for k,Q in enumerate(L):
-            Q.update_variant_number(k+1)
-    for Q in L:
-        qti_insert_question(Q.qti(), T)
-
-    if len(images) > 0:  # we also have images to worry about
-        img_path = os.path.join(subdir, 'Uploaded Media')
-        if not os.path.exists(img_path):
-            os.mkdir(img_path)
-        for img in images:  # now copy accross all the image files
-            target = os.path.join(img_path, os.path.split(img)[-1])
-    #         print(target)
-            copyfile(img, target)
-    assessment_path = os.path.join(subdir, ident)
-    if not os.path.exists(assessment_path):
-        os.mkdir(assessment_path)
-    assessment_filename = os.path.join(assessment_path, ident+'.xml')
-    T.write(assessment_filename, encoding='UTF-8', xml_declaration=True)
-
-    write_manifest(subdir) # create the manifest file
+    if isinstance(cache, str):
+        cache = QtiCache(cache)
+    media = MediaRegistry(None if cache is None else cache.media_names())
+    def questions():
+        for Q in L:    # register the images used in questions in L, as they go past
+            media.add_question(Q)
+            yield Q
+
+    previous_media = use_media(media)
+    try:
+        with qti_identifiers(seed):
+            ident = qti_ident()  # the assessment identifier, also needed for filenames
+            assessment_path = os.path.join(subdir, ident)
+            if not os.path.exists(assessment_path):
+                os.mkdir(assessment_path)
+            assessment_filename = os.path.join(assessment_path, ident+'.xml')
+            with open(assessment_filename, 'wb') as f:
+                write_qti_stream(f, questions(), title=title, ident=ident, make_variant_numbers=make_variant_numbers,
+                                 workers=workers, cache=cache)
+
+            if len(media.blobs) > 0:  # we also have images to worry about
+                img_path = os.path.join(subdir, 'Uploaded Media')
+                if not os.path.exists(img_path):
+                    os.mkdir(img_path)
+                for name, img in media.blobs.items():  # now copy accross each distinct image once
+                    copyfile(img, os.path.join(img_path, name))
+            write_manifest(subdir, ident) # create the manifest file
+            if cache is not None:
+                cache.put_media_names(media.known, media.blobs)
+    finally:
+        use_media(previous_media)
 
     # now write the whole structure to a zip file:
-    os.chdir(subdir)
-    files = get_filepaths('.')
-    with ZipFile(os.path.join('..',zip_filename+'.zip'), 'w') as zipobj:
-        for file in files:
-            zipobj.write(file)
-    os.chdir('..')
+    with ZipFile(zip_filename+'.zip', 'w') as zipobj:
+        for file in get_filepaths(subdir):
+            zipobj.write(file, arcname=os.path.relpath(file, subdir))
     if verbose:
         print(f'Created {zip_filename}.zip. You can upload it to canvas.')
-    if clean_up:
-        destroy(subdir)
+
+def SaveQuizzesToQtiFile(quizzes,
+        zip_filename='upload_me_to_canvas',
+        overwrite=False,
+        make_variant_numbers=True,
+        verbose=False,
+        workers=None,
+        seed=None,
+        cache=None):
+    '''
+    Saves several quizzes to one qti file for uploading to canvas, which then creates one quiz for each.
+    quizzes is a dict mapping quiz titles to lists of Squid questions, e.g. {'Week 1': L1, 'Week 2': L2}.
+    zip_filename should *exclude* the file extension.
+    If overwrite is True (default is False): delete an existing zip_filename first.
+    The other parameters are as for SaveToQtiFile. Images used by several quizzes are only stored once.'''
+    if os.path.exists(zip_filename+'.zip'):
+        if overwrite:
+            os.remove(zip_filename+'.zip')
+        else:
+            print(f'*** {zip_filename}.zip already exists! Use SaveQuizzesToQtiFile(quizzes, overwrite=True) to force deleting it first.')
+            return
+    with ZipFile(zip_filename+'.zip', 'w') as zipobj:
+        write_qti_package(zipobj, quizzes, make_variant_numbers=make_variant_numbers, workers=workers, seed=seed,
+                          cache=cache)
+    if verbose:
+        print(f'Created {zip_filename}.zip with {len(quizzes)} quizzes. You can upload it to canvas.')
+
+################################################################################
+# Reading QTI files back in
+################################################################################
+
+def qti_tag(elem):
+    '''Returns the tag of the ElementTree element elem without its namespace.'''
+    return elem.tag.rpartition('}')[2]
+
+def qti_find(elem, *path):
+    '''Returns the first descendant of elem along the path of (namespace-free) tags, or None.'''
+    for tag in path:
+        elem = next((child for child in elem if qti_tag(child) == tag), None)
+        if elem is None:
+            return None
+    return elem
+
+def qti_findall(elem, tag):
+    '''Returns a list of all descendants of elem with the given (namespace-free) tag.'''
+    return [e for e in elem.iter() if qti_tag(e) == tag]
+
+def qti_mattext(elem):
+    '''Returns the text of the first mattext below elem, or '' if there is none.'''
+    texts = qti_findall(elem, 'mattext')
+    return texts[0].text or '' if texts else ''
+
+qti_media_pattern = re.compile(r'\$IMS-CC-FILEBASE\$/(Uploaded%20Media/[^"\'?]*)')
+
+def qti_untext(s, media=None):
+    '''
+    Undoes qti_text: turns \\( ? \\) back into $?$, and image paths of the form $IMS-CC-FILEBASE$/Uploaded%20Media/...
+    into local paths provided by the function media (which takes the file name inside the package), if given.
+    '''
+    text = re.sub(r'\\\((.*?)\\\)', r'$\1$', s, flags=re.DOTALL)
+    if media is not None:
+        text = qti_media_pattern.sub(lambda m: media(unquote(m.group(1))), text)
+    return text
+
+def qti_item_fields(item):
+    '''Returns a dict with the question_type, title, ident and points_possible of the QTI item element item.'''
+    fields = {'title': item.get('title'), 'ident': item.get('ident')}
+    for field in qti_findall(item, 'qtimetadatafield'):
+        label = qti_find(field, 'fieldlabel')
+        entry = qti_find(field, 'fieldentry')
+        if label is not None and entry is not None:
+            fields[label.text] = entry.text
+    return fields
+
+def qti_choices(lid, order=None):
+    '''Returns a dict mapping the idents of the response_labels in lid to their texts.
+    If order is a comma separated string of idents (like the original_answer_ids of an item), the choices come
+    in that order, which undoes the shuffling of the answers on export.'''
+    choices = {label.get('ident'): qti_mattext(label) for label in qti_findall(lid, 'response_label')}
+    if order:
+        rank = {ident: k for k, ident in enumerate(order.split(','))}
+        choices = dict(sorted(choices.items(), key=lambda choice: rank.get(choice[0], len(rank))))
+    return choices
+
+def qti_scoring(item):
+    '''Returns a list of (respident, value, score, negated) for each varequal in the resprocessing of item,
+    where score is the text of the respcondition's setvar (None if it has none) and negated says
+    whether the varequal sits inside a <not>.'''
+    scoring = []
+    for condition in qti_findall(item, 'respcondition'):
+        setvar = qti_find(condition, 'setvar')
+        score = None if setvar is None else setvar.text
+        negated = {id(v) for n in qti_findall(condition, 'not') for v in qti_findall(n, 'varequal')}
+        for v in qti_findall(condition, 'varequal'):
+            scoring.append((v.get('respident'), (v.text or '').strip(), score, id(v) in negated))
+    return scoring
+
+def qti_parse_item(item, media=None):
+    '''
+    Turns the QTI item element item into a dict describing the question, or None if it isn't one Squid knows.
+    The dict contains question_type (the Canvas name), title, ident, points, text, and depending on the type:
+      multiple_choice_question: answer, wrong_answers
+      multiple_answers_question: answers, wrong_answers
+      numerical_question: answer, tolerance
+      matching_question: pairs, distractors
+      fill_in_multiple_blanks_question: blanks
+    essay_question and file_upload_question have only the text. See qti_untext for media.
+    '''
+    fields = qti_item_fields(item)
+    question_type = fields.get('question_type')
+    untext = lambda s: qti_untext(s, media)
+    presentation = qti_find(item, 'presentation')
+    if presentation is None:
+        return None
+    material = qti_find(presentation, 'material')
+    d = {'question_type': question_type, 'title': fields['title'], 'ident': fields['ident'],
+         'points': float(fields.get('points_possible') or 1),
+         'text': untext(qti_mattext(presentation if material is None else material))}
+    lids = [e for e in presentation if qti_tag(e) == 'response_lid']
+    scoring = qti_scoring(item)
+    if question_type in ('essay_question', 'file_upload_question'):
+        pass
+    elif question_type == 'multiple_choice_question':
+        choices = qti_choices(lids[0], fields.get('original_answer_ids'))
+        correct = [value for respident, value, score, negated in scoring
+                   if not negated and score is not None and float(score) == 100]
+        correct = correct[0] if correct else None
+        d['answer'] = untext(choices.get(correct, ''))
+        d['wrong_answers'] = [untext(a) for k, a in choices.items() if k != correct]
+    elif question_type == 'multiple_answers_question':
+        choices = qti_choices(lids[0], fields.get('original_answer_ids'))
+        correct = {value for respident, value, score, negated in scoring if not negated}
+        d['answers'] = [untext(a) for k, a in choices.items() if k in correct]
+        d['wrong_answers'] = [untext(a) for k, a in choices.items() if k not in correct]
+    elif question_type == 'numerical_question':
+        values = {qti_tag(e): float(e.text) for e in qti_findall(item, 'conditionvar')[0].iter()
+                  if qti_tag(e) in ('varequal', 'vargte', 'varlte', 'vargt', 'varlt') and e.text}
+        low = values.get('vargte', values.get('vargt'))
+        high = values.get('varlte', values.get('varlt'))
+        if 'varequal' in values:
+            answer = values['varequal']
+        elif low is not None and high is not None:
+            answer = (low+high)/2
+        else:
+            answer = low if low is not None else high
+        d['answer'] = answer
+        tolerance = 0 if low is None or high is None else max(answer-low, high-answer)
+        d['tolerance'] = float('%.12g'%tolerance)  # remove rounding errors from the subtraction
+    elif question_type == 'matching_question':
+        correct = {respident: value for respident, value, score, negated in scoring if not negated}
+        rights = {}
+        d['pairs'] = []
+        for lid in lids:
+            choices = qti_choices(lid)
+            rights.update(choices)
+            d['pairs'].append((untext(qti_mattext(qti_find(lid, 'material'))),
+                               untext(choices.get(correct.get(lid.get('ident')), ''))))
+        used = set(correct.values())
+        d['distractors'] = [untext(a) for k, a in rights.items() if k not in used]
+    elif question_type == 'fill_in_multiple_blanks_question':
+        d['blanks'] = {qti_mattext(qti_find(lid, 'material')): [untext(a) for a in qti_choices(lid).values()]
+                       for lid in lids}
+    else:
+        return None
+    return d
+
+def qti_assessment_names(zipobj):
+    '''Returns the names of the assessment files ident/ident.xml in the zip file zipobj, in order.'''
+    names = []
+    for name in zipobj.namelist():
+        folder, _, filename = name.rpartition('/')
+        if filename == folder.rpartition('/')[2]+'.xml':
+            names.append(name)
+    return names
+
+def iter_qti_items(f, media=None):
+    '''
+    Yields a dict (see qti_parse_item) for each question in the QTI assessment file f (a filename or open file),
+    with the title of the assessment it came from added as 'assessment'.
+    The file is parsed incrementally and each item is discarded once read, so memory use stays flat
+    even for very large files. Question types Squid doesn't know are reported as dicts with only
+    question_type, title, ident and assessment.
+    '''
+    parents = []
+    assessment = None
+    for event, elem in ET.iterparse(f, events=('start', 'end')):
+        if event == 'start':
+            if qti_tag(elem) == 'assessment':
+                assessment = elem.get('title')
+            parents.append(elem)
+            continue
+        parents.pop()
+        if qti_tag(elem) != 'item':
+            continue
+        d = qti_parse_item(elem, media)
+        if d is None:
+            fields = qti_item_fields(elem)
+            d = {'question_type': fields.get('question_type'), 'title': fields['title'], 'ident': fields['ident']}
+        d['assessment'] = assessment
+        yield d
+        elem.clear()
+        if parents:
+            parents[-1].remove(elem)
+
+def ReadQtiFile(zip_filename, media_dir='Squid_imported_media'):
+    '''
+    Yields a dict (see qti_parse_item) for each question in the QTI package zip_filename, e.g. one exported from Canvas
+    or made with SaveToQtiFile (or SaveQuizzesToQtiFile: each dict records the title of its quiz as 'assessment').
+    Images the questions use are copied from "Uploaded Media" in the package to the folder media_dir as they are
+    encountered, and the questions' image tags point there. If media_dir is None, images are left alone.
+    zip_filename may also be a single QTI .xml file.
+    '''
+    if not zip_filename.endswith('.zip'):
+        yield from iter_qti_items(zip_filename)
+        return
+    with ZipFile(zip_filename) as zipobj:
+        names = set(zipobj.namelist())
+        restored = {}
+        def media(name):
+            if name not in restored:
+                path = os.path.join(media_dir, os.path.split(name)[-1])
+                if name in names:
+                    os.makedirs(media_dir, exist_ok=True)
+                    with zipobj.open(name) as src, open(path, 'wb') as dst:
+                        copyfileobj(src, dst)
+                restored[name] = path
+            return restored[name]
+        for name in qti_assessment_names(zipobj):
+            with zipobj.open(name) as f:
+                yield from iter_qti_items(f, None if media_dir is None else media)
@@ -0,0 +1,123 @@
+# Drawing images for question variants with matplotlib, e.g. a contour plot for each variant.
+#
+# A plot is described by a drawing function and its parameters: draw(ax, **params) draws on the matplotlib
+# axes ax. The png file is named by a hash of these, so a plot that is already on disk is never drawn again,
+# and a pool can be regenerated without redrawing its images. Figures are reused rather than created for every
+# plot, grids shared by many plots are computed once, and render_plots draws many plots in parallel.
+#
+# Example:
+#     def draw_contours(ax, a, b, s1, s2):
+#         X, Y = grid((-5, 5), (-5, 5), 100)
+#         Z = 1 + s1*(X-a)**2 + s2*(Y-b)**2
+#         ax.clabel(ax.contour(X, Y, Z, 20, colors='black', linestyles='solid'), inline=True, fontsize=8)
+#         ...
+#     params = [dict(a=a, b=b, s1=s1, s2=s2) for a in range(-3, 4) for b in range(-3, 4) for s1, s2 in signs]
+#     paths = render_plots(draw_contours, params)   # draws all plots that aren't on disk yet, in parallel
+#     ...
+#     Q.question_text = Q.add_image(path, width="50%")+'<br>Classify the critical point...'
+
+import os
+import hashlib
+import multiprocessing
+from functools import lru_cache
+import numpy as np
+from matplotlib.figure import Figure
+from squid_utils import canonical
+
+default_savefig_kwargs = {'dpi': 160, 'bbox_inches': 'tight', 'transparent': False}
+
+def plot_filename(draw, params=(), img_dir='images', figsize=(5, 5), version=0, ext='png', **savefig_kwargs):
+    '''
+    Returns the filename render_plot uses for the plot drawn by draw with params: in img_dir, the name of draw
+    followed by a hash of everything that determines the picture, e.g. "images/draw_contours_0123456789abcdef.png".
+    Array parameters count with all of their entries, dtype and shape (see canonical), so plots whose arrays
+    differ anywhere get different files. Change version when you change the drawing function, so that the plots are drawn again.
+    '''
+    key = canonical([draw.__qualname__, params, figsize, version,
+                     {**default_savefig_kwargs, **savefig_kwargs}])
+    name = draw.__name__+'_'+hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]+'.'+ext
+    return os.path.join(img_dir, name)
+
+@lru_cache(maxsize=32)
+def grid(xlim=(-5, 5), ylim=(-5, 5), n=100):
+    '''
+    Returns the arrays X, Y of np.meshgrid for n points in each of the intervals xlim and ylim.
+    The result is cached, so the plots of many variants share one grid; the arrays are read-only.
+    '''
+    X, Y = np.meshgrid(np.linspace(*xlim, n), np.linspace(*ylim, n))
+    X.flags.writeable = False
+    Y.flags.writeable = False
+    return X, Y
+
+_figures = {}  # figsize: Figure, reused by figure_axes (each process has its own)
+
+def figure_axes(figsize=(5, 5)):
+    '''
+    Returns (fig, ax): a cleared matplotlib figure of size figsize with one axes, reused from the previous call with
+    the same figsize. The figure is not managed by pyplot, so it is not shown in the notebook and needn't be closed.
+    '''
+    fig = _figures.get(figsize)
+    if fig is None:
+        fig = _figures[figsize] = Figure(figsize=figsize)
+    elif len(fig.axes) == 1:
+        ax = fig.axes[0]
+        ax.clear()
+        return fig, ax
+    else:  # e.g. a colorbar was added
+        fig.clear()
+    return fig, fig.add_subplot()
+
+def render_plot(draw, params=(), filename=None, img_dir='images', figsize=(5, 5), version=0, overwrite=False,
+                **savefig_kwargs):
+    '''
+    Draws a plot with draw(ax, **params) (or draw(ax, *params) if params is a list or tuple), saves it and
+    returns its filename (by default plot_filename(draw, params, ...)).
+    If the file already exists, nothing is drawn, unless overwrite is True.
+    savefig_kwargs are passed to savefig, see default_savefig_kwargs.
+    '''
+    if filename is None:
+        filename = plot_filename(draw, params, img_dir, figsize, version, **savefig_kwargs)
+    if overwrite or not os.path.exists(filename):
+        fig, ax = figure_axes(figsize)
+        if isinstance(params, dict):
+            draw(ax, **params)
+        else:
+            draw(ax, *params)
+        directory, name = os.path.split(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp = os.path.join(directory, f'.{os.getpid()}_{name}')  # so no one sees a half-written file
+        fig.savefig(temp, **{**default_savefig_kwargs, **savefig_kwargs})
+        os.replace(temp, filename)
+    return filename
+
+def _render_plot(job):
+    '''Draws one plot for render_plots, in a worker process.'''
+    draw, params, filename, figsize, savefig_kwargs = job
+    return render_plot(draw, params, filename, figsize=figsize, overwrite=True, **savefig_kwargs)
+
+def render_plots(draw, param_list, img_dir='images', figsize=(5, 5), version=0, overwrite=False, workers=None,
+                 chunksize=4, **savefig_kwargs):
+    '''
+    Draws a plot with draw for each params in param_list (see render_plot) and returns the list of their filenames,
+    in the same order. Only plots that aren't on disk yet (or all, if overwrite is True) are drawn, each once,
+    in a pool of workers processes (default: one per CPU; workers=1 draws them here).
+    draw must be picklable, i.e. a function defined at the top level of a module or notebook.
+    '''
+    filenames = [plot_filename(draw, params, img_dir, figsize, version, **savefig_kwargs) for params in param_list]
+    jobs = {}
+    for params, filename in zip(param_list, filenames):
+        if filename not in jobs and (overwrite or not os.path.exists(filename)):
+            jobs[filename] = (draw, params, filename, figsize, savefig_kwargs)
+    jobs = list(jobs.values())
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(jobs))
+    if workers <= 1:
+        for job in jobs:
+            _render_plot(job)
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            for _ in pool.imap_unordered(_render_plot, jobs, chunksize):
+                pass
+    return filenames
@@ -3,8 +3,17 @@
 from html.parser import HTMLParser
 import string
 import random
+import hashlib
 import re
 import os
+import sys
+import time
+import pickle
+import sqlite3
+import functools
+import operator
+from fractions import Fraction
+import multiprocessing
 
 
 def img_width2latex(text):
@@ -27,6 +36,179 @@ def img_height2latex(text):
         return f'height={round(int(text[:-2])*0.75)}px'
     return f'height={text}'
 
+class Html2LatexParser(HTMLParser):
+    '''
+    Converts html to latex in a single pass, see html2latex. A parser can be reused for any number of texts.
+
+    The tags with a fixed translation are looked up in start_tags and end_tags, the others have a method
+    start_<tag> or end_<tag>. Tables are made into tabular environments: the cells of a table are collected
+    on a stack until the table is closed, when the number of its columns is known.
+    '''
+    # these tags will be ignored, i.e. their tag name and attributes will be excluded:
+    ignored_tags = {'head', 'body', 'meta', 'html', 'title', 'script', 'thead', 'tbody', 'tfoot',
+                    'div', 'span', 'link', 'header', 'h5', 'style', 'font'}
+    start_tags = {'hr': '\n' + r'\par\noindent\rule{\textwidth}{0.4pt}' + '\n',
+                  'b': r'{\bf ', 'i': r'{\it ', 'em': r'{\em ', 'u': r'\underline{', 'tt': r'\texttt{',
+                  'br': '\n\n', 'p': '\n',
+                  'h1': r'{\Large\bf ', 'h2': r'{\large\bf ', 'h3': r'{\bf\it ', 'h4': r'{\bf ',
+                  'ul': r'\begin{itemize}'+'\n', 'ol': r'\begin{enumerate}'+'\n', 'li': r'\item '}
+    end_tags = {'b': '} ', 'i': '} ', 'u': '} ', 'a': '} ', 'em': '} ', 'tt': '} ',
+                'h1': '}\n', 'h2': '}\n', 'h3': '}\n', 'h4': '}\n', 'p': '\n', 'li': '\n',
+                'ul': r'\end{itemize}'+'\n', 'ol': r'\end{enumerate}'+'\n'}
+
+    def __init__(self, verbose=False):
+        super().__init__()
+        self.verbose = verbose
+
+    def convert(self, text):
+        '''Returns the html text converted to latex.'''
+        self.reset()
+        self.output = []  # list of strings, to be joined later
+        self.tables = []  # for each open table: [output outside it, columns, cells in current row or None, closer of current cell, border]
+        self.feed(text)
+        self.close()  # flushes the text after a '<' that doesn't start a tag, e.g. in "x<y"
+        while self.tables:  # tables that weren't closed
+            self.end_table()
+        return ''.join(self.output)
+
+    def handle_starttag(self, tag, attrs):
+        s = self.start_tags.get(tag)
+        if s is not None:
+            self.output.append(s)
+        elif tag in self.ignored_tags:
+            pass   # we ignore these tags, since we don't want to typeset them
+        else:
+            handler = getattr(self, 'start_'+tag, None)
+            if handler is not None:
+                handler(attrs)
+            else:  # a tag we don't know about that parse_starttag let through, e.g. "<b<c>": keep it as text
+                self.handle_data(self.get_starttag_text())
+
+    tag_name_pattern = re.compile(r'[a-zA-Z][^\t\n\r\f />\x00<]*')  # as HTMLParser's, but stops at the next '<'
+
+    def parse_starttag(self, i):
+        '''
+        Parses the start tag at position i of the text, unless it is a tag we don't know about. That might be math
+        and not a tag at all (as in "$x<y$"), so then only its '<' is taken as text, and parsing carries on right
+        after it: whatever follows is converted in the same pass, including any tags in it.
+        '''
+        tag = self.tag_name_pattern.match(self.rawdata, i+1).group().lower()
+        if tag in self.start_tags or tag in self.ignored_tags or hasattr(self, 'start_'+tag):
+            return super().parse_starttag(i)
+        if self.verbose:
+            print(f'opening tag <{tag}> ignored.')
+        self.handle_data('<')
+        return i+1
+
+    def handle_endtag(self, tag):
+        s = self.end_tags.get(tag)
+        if s is not None:
+            self.output.append(s)
+        elif tag in self.ignored_tags:
+            pass   # we ignore these tags, since we don't want to typeset them
+        else:
+            handler = getattr(self, 'end_'+tag, None)
+            if handler is not None:
+                handler()
+            else:
+                self.output.append('</'+tag+'> ')   # some unknown tag, perhaps part of an equation...
+                if self.verbose:
+                    print(f'closing tag </{tag}> ignored.')
+
+    def handle_data(self, data):
+        self.output.append(data)
+
+    def start_img(self, attrs):
+        wh = []
+        filename = ''
+        for key, value in attrs:
+            if key == 'src':
+                filename = value
+            if key == 'height':
+                wh.append(img_height2latex(value))
+            if key == 'width':
+                wh.append(img_width2latex(value))
+        self.output.append(r'\includegraphics')
+        if len(wh) > 0:
+            self.output.append('[' + ', '.join(wh) + ']')
+        self.output.append('{' + filename + '}')
+
+    def start_a(self, attrs):
+        self.output.append(r'\href{'+(dict(attrs).get('href') or '')+'}{')
+
+    def start_table(self, attrs):
+        border = dict(attrs).get('border') not in (None, '', '0')
+        self.tables.append([self.output, 0, None, '', border])
+        self.output = []
+        if border:
+            self.output.append(r'\hline'+'\n')
+
+    def end_table(self):
+        if not self.tables:
+            return
+        self.end_tr()
+        outside, columns, _, _, border = self.tables.pop()
+        spec = '|'+'l|'*columns if border else 'l'*columns
+        outside.append('\n'+r'\begin{tabular}{'+spec+'}\n'+''.join(self.output)+r'\end{tabular}'+'\n')
+        self.output = outside
+
+    def start_tr(self, attrs=()):
+        if not self.tables:
+            return
+        self.end_tr()
+        self.tables[-1][2] = 0
+
+    def end_tr(self):
+        if not self.tables:
+            return
+        table = self.tables[-1]
+        if table[2] is None:  # no open row
+            return
+        self.end_td()
+        table[1] = max(table[1], table[2])
+        table[2] = None
+        self.output.append(r'\\'+(r' \hline' if table[4] else '')+'\n')
+
+    def start_td(self, attrs, header=False):
+        if not self.tables:
+            return
+        table = self.tables[-1]
+        if table[2] is None:  # a cell outside of a row
+            self.start_tr()
+        self.end_td()
+        if table[2] > 0:
+            self.output.append(' & ')
+        span = dict(attrs).get('colspan') or '1'
+        span = int(span) if span.isdigit() and int(span) > 0 else 1
+        table[2] += span
+        opening, table[3] = ('', '')
+        if span > 1:
+            opening, table[3] = r'\multicolumn{'+str(span)+'}{'+('|l|' if table[4] else 'l')+'}{', '}'
+        if header:
+            opening, table[3] = opening+r'{\bf ', '}'+table[3]
+        self.output.append(opening)
+
+    def start_th(self, attrs):
+        self.start_td(attrs, header=True)
+
+    def end_td(self):
+        if self.tables and self.tables[-1][3]:
+            self.output.append(self.tables[-1][3])
+            self.tables[-1][3] = ''
+
+    end_th = end_td
+
+_html2latex_parser = Html2LatexParser()
+
+html2latex_cache = {}  # html: latex, filled by html2latex and convert_many
+html2latex_cache_size = 20000  # when the cache is full, the oldest conversions are dropped
+
+def cache_latex(text, latex):
+    '''Remembers that html2latex(text) is latex.'''
+    if len(html2latex_cache) >= html2latex_cache_size:
+        del html2latex_cache[next(iter(html2latex_cache))]
+    html2latex_cache[text] = latex
+
 def html2latex(text, verbose=False):
     '''
     Convert some html to latex.
@@ -35,107 +217,110 @@ def html2latex(text, verbose=False):
     Implemented thus far:
       - <img>, with attributes height and width, either in px or %
       - <hr> <b> <i> <em> <u> <br> <p> <h1> <h2> <h3> <h4> <ol> <ul> <li> <a> <tt>
+      - <table> <tr> <td> <th>, as a tabular with as many columns as its longest row (with lines if it has a border),
+        and colspan
+
+    Conversions are cached, so the text shared by many variants (or an answer used in many questions) is only
+    converted once; see also convert_many. With verbose=True, the unknown tags are reported (and nothing is cached).
 
     To do:
-      - tables   ... will require some sort of stack to count the number of columns, then go back and add the "lll"s
       - download and embed images if their src is a url?
       - <code>
       - Maybe do something interesting with comments?
     '''
-    output = []  # list of strings, to be joined later
-    # ignore_tags will be ignored, i.e. their tag name and attributes will be excluded:
-    ignored_tags = ['td', 'tr', 'th', 'thead', 'table', 'head', 'body', 'meta', 'html', 'tbody', 'title', 'script',
-                    'div', 'span', 'link', 'header', 'h5', 'style', 'font']
-    class myparser(HTMLParser):
-        def handle_starttag(self, tag, attrs):
-            nonlocal output  # we'll be modifying this as we go
-            if tag == 'img':
-                wh = []
-                for key, value in attrs:
-                    if key == 'src':
-                        filename = value
-                    if key == 'height':
-                        wh.append(img_height2latex(value))
-                    if key == 'width':
-                        wh.append(img_width2latex(value))
-                output.append(r'\includegraphics')
-                if len(wh) > 0:
-                    output.append('[' + ', '.join(wh) + ']')
-                output.append('{' + filename + '}')
-            elif tag == 'hr':
-                output.append('\n' + r'\par\noindent\rule{\textwidth}{0.4pt}' + '\n')
-            elif tag == 'b':
-                output.append(r'{\bf ')
-            elif tag == 'i':
-                output.append(r'{\it ')
-            elif tag == 'em':
-                output.append(r'{\em ')
-            elif tag == 'u':
-                output.append(r'\underline{')
-            elif tag == 'tt':
-                output.append(r'\texttt{')
-            elif tag == 'br':
-                output.append('\n\n')
-            elif tag == 'p':
-                output.append('\n')
-            elif tag == 'h1':
-                output.append(r'{\Large\bf ')
-            elif tag == 'h2':
-                output.append(r'{\large\bf ')
-            elif tag == 'h3':
-                output.append(r'{\bf\it ')
-            elif tag == 'h4':
-                output.append(r'{\bf ')
-            elif tag == 'ul':
-                output.append(r'\begin{itemize}'+'\n')
-            elif tag == 'ol':
-                output.append(r'\begin{enumerate}'+'\n')
-            elif tag == 'li':
-                output.append(r'\item ')
-            elif tag == 'a':
-                for key, value in attrs:
-                    if key == 'href':
-                        target = value
-                output.append(r'\href{'+target+'}{')
-            elif tag in ignored_tags:
-                pass   # we ignore these tags, since we don't want to typeset them
-            else:      # a tag we don't know about, it might be math and not a tag at all, so let's do something with it
-                unknown_tag = self.get_starttag_text()
-                output.append('<'+html2latex(unknown_tag[1:]))  # if a valid tag closed this, then we want it processed!
-                if verbose:
-                    print(f'opening tag <{tag}> ignored. Exact text:')
-                    print('  "'+unknown_tag+'"')
-
-
-
-        def handle_endtag(self, tag):
-            if tag in ['b', 'i', 'u', 'a', 'em','tt']:
-                output.append('} ')
-            elif tag in ['h1', 'h2', 'h3', 'h4']:
-                output.append('}\n')
-            elif tag in ['p', 'li']:
-                output.append('\n')
-            elif tag == 'ul':
-                output.append(r'\end{itemize}'+'\n')
-            elif tag == 'ol':
-                output.append(r'\end{enumerate}'+'\n')
-            elif tag in ignored_tags:
-                pass   # we ignore these tags, since we don't want to typeset them
-            else:
-                output.append('</'+tag+'> ')   # some unknown tag, perhaps part of an equation...
-                if verbose:
-                    print(f'closing tag </{tag}> ignored.')
+    if verbose:
+        return Html2LatexParser(verbose=True).convert(text)
+    latex = html2latex_cache.get(text)
+    if latex is None:
+        latex = _html2latex_parser.convert(text)
+        cache_latex(text, latex)
+    return latex
 
-        def handle_data(self, data):
-            output.append(data)
+def _convert_html(text):
+    '''Converts text with html2latex's parser, in a worker process of convert_many.'''
+    return _html2latex_parser.convert(text)
 
-    parser = myparser()
-    parser.feed(text)
-    return ''.join(output)
+def convert_many(texts, workers=1, chunksize=64):
+    '''
+    Returns the list of html2latex(text) for all text in texts (e.g. the question texts of a whole pool),
+    converting each distinct text only once. The results are cached, so calling html2latex on these texts
+    afterwards (as latex_sorted, latex_shuffled and the marking schemes do) just looks them up.
+    With workers > 1 (or None, for one per CPU) the texts are converted in a pool of processes, in chunks of
+    chunksize texts; this only pays off for many thousands of different texts.
+    '''
+    texts = list(texts)
+    results = {text: html2latex_cache.get(text) for text in texts}
+    todo = [text for text, latex in results.items() if latex is None]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers > 1 and len(todo) > chunksize:
+        with multiprocessing.Pool(workers) as pool:
+            converted = pool.map(_convert_html, todo, chunksize)
+    else:
+        converted = [_html2latex_parser.convert(text) for text in todo]
+    for text, latex in zip(todo, converted):
+        results[text] = latex
+        cache_latex(text, latex)
+    return [results[text] for text in texts]
 
 def id_generator(size=6, chars=string.ascii_lowercase + string.digits):
     '''Returns a (cryptographically insecure!) random identifier of length size'''
-    return ''.join(random.choice(chars) for _ in range(size))
+    return ''.join(random.choices(chars, k=size))
+
+class IdentifierService(object):
+    '''
+    Generates identifiers for an export (e.g. a QTI package) which are reproducible and unique.
+
+    Identifiers are not drawn from the global random module. Instead, each one is a hash of the seed,
+    the number of the item it belongs to and a counter within that item, so an export made with the
+    same seed is the same every time, and items can be generated in any order (or in different
+    processes) without changing the result.
+
+    Item 0 stands for the package itself (assessment and manifest identifiers); new_item() hands out
+    the numbers 1, 2, 3, ... for the questions.
+
+    seed : any string or number. If None (default), a random one is made with id_generator.
+
+    ATTRIBUTES:
+        seed : str
+        item : the number of the current item
+        random : a random.Random for the current item, e.g. for shuffling its answers
+    '''
+    def __init__(self, seed=None):
+        if seed is None:
+            seed = id_generator(16)
+        self.seed = str(seed)
+        self.items = 0      # the number of items handed out by new_item
+        self.counters = {}  # item number -> number of hex_ids generated for it so far
+        self.start_item(0)
+
+    def new_item(self):
+        '''Returns a new item number, unique within this service.'''
+        self.items += 1
+        return self.items
+
+    def start_item(self, item):
+        '''Makes item the current item, i.e. the one the next identifiers belong to.'''
+        self.item = item
+        self.answers = 0
+        self.random = random.Random(f'{self.seed}:{item}')
+
+    def hex_id(self, size=30):
+        '''Returns an identifier consisting of size hex digits.'''
+        counter = self.counters.get(self.item, 0)
+        self.counters[self.item] = counter+1
+        digest = hashlib.blake2b(f'{self.seed}:{self.item}:{counter}'.encode(), digest_size=(size+1)//2)
+        return digest.hexdigest()[:size]
+
+    def answer_ids(self, n):
+        '''Returns a list of n numerical answer identifiers (as strings).
+        These are 1000 + 100*item + k for the k-th answer of the item, hence unique in the whole export,
+        provided no item has more than 100 answers.'''
+        if self.answers + n > 100:
+            raise ValueError(f'Item {self.item} has more than 100 answers.')
+        ids = [str(1000 + 100*self.item + k) for k in range(self.answers, self.answers+n)]
+        self.answers += n
+        return ids
 
 # I need to extend the followinf get_img_filenames and qti_img_tags (and html2latex) so that it  can handle
 # image sources which are urls.
@@ -145,6 +330,231 @@ def get_img_filenames(s):
     For now, assumes img src is a local file, not a url!'''
     return [m.group('filename') for m in re.finditer('<img\\s*src=(?P<quote>[\'"])(?P<filename>.*?)(?P=quote)', s)]
 
+def get_question_img_filenames(Q):
+    '''Returns a list of the image filenames used in the Squid question Q (including its answers).
+    If images were registered with Q.add_image, these are returned without looking at the text.'''
+    if getattr(Q, 'images', None):
+        return list(Q.images)
+    images = get_img_filenames(Q.q_text())
+    if hasattr(Q, 'answer_texts'):
+        for a in Q.answer_texts():
+            images.extend(get_img_filenames(a))
+    elif Q.question_type == 'MCQ':
+        images.extend(get_img_filenames(Q.answer))
+        for wa in Q.wrong_answers:
+            images.extend(get_img_filenames(wa))
+    return images
+
+def sage_parent(obj):
+    '''Returns the name of the parent of obj (e.g. "Rational Field") if it is a Sage element, otherwise None.'''
+    if type(obj).__module__.startswith('sage.') and callable(getattr(obj, 'parent', None)):
+        return str(obj.parent())
+    return None
+
+def json_default(obj):
+    '''
+    Converts objects json doesn't know (e.g. Sage numbers in question attributes) for json.dumps(..., default=json_default).
+    Nothing is rounded: Python and numpy integers become ints and other numpy numbers their Python equivalent,
+    a Fraction becomes {"__fraction__": "1/3"}, and Sage integers, rationals and reals become
+    {"__integer__": "2"}, {"__rational__": "1/3"} and {"__real__": "0.333333333333333", "prec": 53}.
+    json_object_hook turns these back into the objects when loading (into ints, Fractions and floats without Sage).
+    Raises TypeError for any other object, so the pool file never needs a class (or pickle) to be read.
+    '''
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    parent = sage_parent(obj)
+    if parent == 'Integer Ring':
+        return {'__integer__': str(obj)}
+    if parent == 'Rational Field':
+        return {'__rational__': str(obj)}
+    if parent is not None and parent.startswith('Real Field with'):
+        return {'__real__': str(obj), 'prec': int(obj.prec())}
+    if type(obj).__module__ == 'numpy' and hasattr(obj, 'tolist'):
+        return obj.tolist()
+    if isinstance(obj, Fraction):
+        return {'__fraction__': str(obj)}
+    try:
+        return operator.index(obj)
+    except TypeError:
+        pass
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable in a Squid pool: '
+                    'store it as a str, or as a number json_default knows.')
+
+def json_object_hook(d):
+    '''Rebuilds the objects that json_default has tagged, for json.loads(..., object_hook=json_object_hook).'''
+    sage = sys.modules.get('sage.all')
+    if '__fraction__' in d:
+        return Fraction(d['__fraction__'])
+    if '__integer__' in d:
+        return sage.ZZ(d['__integer__']) if sage else int(d['__integer__'])
+    if '__rational__' in d:
+        return sage.QQ(d['__rational__']) if sage else Fraction(d['__rational__'])
+    if '__real__' in d:
+        return sage.RealField(d['prec'])(d['__real__']) if sage else float(d['__real__'])
+    return d
+
+class MediaRegistry(object):
+    '''
+    Keeps track of the image files used by a collection of questions, deduplicated by their contents.
+
+    Each distinct file content gets a stable name: the first 16 hex digits of the SHA-256 of the contents,
+    followed by the file extension, e.g. "0123456789abcdef.png". So the same picture used by many questions
+    (even under different filenames) is stored once, and two different files called plot.png in different
+    directories no longer overwrite each other. Since names depend only on the contents, they are the same
+    in every process and every export.
+
+    ATTRIBUTES:
+        names : dict mapping image paths (as used in the questions) to their stored names
+        blobs : dict mapping stored names to the first path seen with those contents
+        known : dict mapping the absolute path, size and modification time of image files (as a str) to their
+                stored names, so that files which haven't changed aren't hashed again, e.g. in the next export
+                (see squid_qti.QtiCache). Pass it to the next MediaRegistry.
+    '''
+    def __init__(self, known=None):
+        self.names = {}
+        self.blobs = {}
+        self.known = {} if known is None else known
+
+    def add(self, path):
+        '''Registers the image file path (if it is new) and returns its stored name.'''
+        name = self.names.get(path)
+        if name is None:
+            stat = os.stat(path)
+            stamp = f'{os.path.abspath(path)}\0{stat.st_size}\0{stat.st_mtime_ns}'
+            name = self.known.get(stamp)
+            if name is None:
+                h = hashlib.sha256()
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 16), b''):
+                        h.update(chunk)
+                name = self.known[stamp] = h.hexdigest()[:16] + os.path.splitext(path)[1]
+            self.names[path] = name
+            self.blobs.setdefault(name, path)
+        return name
+
+    def add_question(self, Q):
+        '''Registers all images used in the Squid question Q, returns the list of their stored names.'''
+        return [self.add(img) for img in get_question_img_filenames(Q)]
+
+def canonical(x):
+    '''
+    Returns a string representing x for use in cache keys: equal (and equally typed) arguments give equal strings.
+    Works for numbers, strings, lists, tuples, dicts, NumPy arrays and Sage objects such as expressions and matrices,
+    whose string form is prefixed with their parent (e.g. the ring of a matrix), so 1/2 in QQ and 0.5 in RR differ.
+    Big arrays and matrices are represented by all of their entries, not by their repr, which leaves entries out.
+    '''
+    if isinstance(x, (list, tuple)):
+        return type(x).__name__+'('+','.join(canonical(y) for y in x)+')'
+    if isinstance(x, dict):
+        return 'dict('+','.join(canonical(k)+':'+canonical(x[k]) for k in sorted(x, key=canonical))+')'
+    if type(x).__module__ == 'numpy' and hasattr(x, 'tobytes'):  # a NumPy array or scalar
+        if x.dtype.hasobject:
+            return f'{type(x).__name__}[{x.dtype},{x.shape}]:'+canonical(x.tolist())
+        return f'{type(x).__name__}[{x.dtype},{x.shape}]:'+hashlib.sha256(x.tobytes()).hexdigest()
+    if hasattr(x, 'parent') and callable(x.parent):  # a Sage element
+        if callable(getattr(x, 'nrows', None)) and callable(getattr(x, 'str', None)):  # a matrix
+            return f'{type(x).__name__}[{x.parent()}]:{x.str()}'
+        return f'{type(x).__name__}[{x.parent()}]:{x!r}'
+    return f'{type(x).__name__}:{x!r}'
+
+class MemoCache(object):
+    '''
+    A persistent, bounded cache of function results, stored in the SQLite file path, so that e.g. the algebra
+    behind a pool of Sage-generated variants isn't redone when the pool is regenerated after a wording change,
+    even in a new notebook session. Use it through memoize.
+
+    When there are more than max_entries results, the least recently used ones are evicted.
+    Results must be picklable (strings, numbers, Sage objects). The cache can be shared by several processes,
+    e.g. the workers of generate_variants.
+    '''
+    def __init__(self, path='Squid_memo_cache.sqlite', max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.pid = None
+        self.touched = []  # keys of hits whose time of use hasn't been written yet (see get)
+
+    def connect(self):
+        '''Returns the connection to the database, (re)opening it in each process.'''
+        if self.pid != os.getpid():
+            self.db = sqlite3.connect(self.path, timeout=60)
+            self.db.execute('CREATE TABLE IF NOT EXISTS memo (key TEXT PRIMARY KEY, value BLOB, used INTEGER)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS memo_used ON memo (used)')
+            self.size = self.db.execute('SELECT COUNT(*) FROM memo').fetchone()[0]
+            self.pid = os.getpid()
+        return self.db
+
+    def key(self, name, args, kwargs):
+        '''Returns the key for calling the function called name with args and kwargs.'''
+        return hashlib.sha256((name+'\0'+canonical(args)+'\0'+canonical(kwargs)).encode('UTF-8')).hexdigest()
+
+    def get(self, key):
+        '''Returns (True, result) if a result for key is cached, otherwise (False, None).'''
+        db = self.connect()
+        row = db.execute('SELECT value FROM memo WHERE key=?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        self.touched.append(key)
+        if len(self.touched) >= 100:  # record the times of use in batches, rather than writing on every hit
+            self.touch()
+        return True, pickle.loads(row[0])
+
+    def touch(self):
+        '''Marks the keys of the hits since the last touch() as just used, for the LRU eviction.'''
+        now = time.time_ns()
+        with self.connect() as db:
+            db.executemany('UPDATE memo SET used=? WHERE key=?', [(now, key) for key in self.touched])
+        self.touched = []
+
+    def put(self, key, result):
+        '''Stores result under key, evicting the least recently used results if the cache is full.'''
+        self.touch()
+        db = self.connect()
+        with db:
+            new = db.execute('SELECT 1 FROM memo WHERE key=?', (key,)).fetchone() is None
+            db.execute('INSERT OR REPLACE INTO memo VALUES (?, ?, ?)', (key, pickle.dumps(result), time.time_ns()))
+            self.size += new
+            if self.size > self.max_entries:  # evict a tenth, so this doesn't happen on every put
+                db.execute('DELETE FROM memo WHERE key IN (SELECT key FROM memo ORDER BY used LIMIT ?)',
+                           (self.size-self.max_entries*9//10,))
+                self.size = db.execute('SELECT COUNT(*) FROM memo').fetchone()[0]
+
+    def clear(self):
+        '''Deletes all cached results.'''
+        with self.connect() as db:
+            db.execute('DELETE FROM memo')
+        self.size = 0
+
+memo_cache = MemoCache()  # the cache memoize uses by default
+
+def memoize(func=None, cache=None, version=0):
+    '''
+    Decorator making func remember its results in a MemoCache (default memo_cache), keyed by the name of func,
+    version and the canonical form (see canonical) of its arguments:
+
+        @memoize
+        def Taylor(f, a=0, n=10): ...
+
+    Bump version when func changes, so its old results are no longer used.
+    The results must only depend on the arguments: don't memoize functions using random numbers.
+    '''
+    if func is None:
+        return lambda func: memoize(func, cache, version)
+    name = f'{func.__module__}.{func.__qualname__}:{version}'
+    @functools.wraps(func)
+    def memoized(*args, **kwargs):
+        c = memo_cache if cache is None else cache
+        key = c.key(name, args, kwargs)
+        found, result = c.get(key)
+        if not found:
+            result = func(*args, **kwargs)
+            c.put(key, result)
+        return result
+    return memoized
+
 class MATHJAX():
     '''Takes an HTML formatted string with embedded LaTeX and typesets it. By Bjoern Rueffer'''
     def __init__(self,s):
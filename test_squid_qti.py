@@ -0,0 +1,46 @@
+# Tests for squid_qti. Run with: python -m pytest
+
+import io
+import squid_qti
+from squid_qti import write_qti_stream, initialise_qti, ET_MCQ, qti_text
+
+class ImageQuestion(object):
+    '''A minimal multiple choice question showing an image, standing in for squid.Question_MCQ
+    (squid itself needs ipywidgets).'''
+    question_type = 'MCQ'
+
+    def __init__(self, img, k):
+        self.question_text = f'<img src="{img}"> Question {k}'
+        self.variant_number = 0
+
+    def update_variant_number(self, variant_number=None):
+        if variant_number is not None:
+            self.variant_number = variant_number
+
+    def q_text(self):
+        return self.question_text
+
+    def answer_texts(self):
+        return ['a', 'b', 'c', 'd']
+
+    def qti(self):
+        return ET_MCQ(text=qti_text(self.question_text), title=f'Question {self.variant_number}',
+                      answer='a', wrong_answers=['b', 'c', 'd'])
+
+def qti_bytes(questions, workers):
+    f = io.BytesIO()
+    write_qti_stream(f, questions, ident='assessment', workers=workers, seed=1)
+    return f.getvalue()
+
+def test_workers_name_images_like_serial_without_media_registry(tmp_path):
+    initialise_qti(verbose=False)
+    assert squid_qti.qti_media is None
+    images = []
+    for k in range(3):
+        images.append(str(tmp_path / f'plot({k}, -1).png'))
+        with open(images[-1], 'wb') as f:
+            f.write(bytes([k])*100)
+    questions = [ImageQuestion(images[k % 3], k) for k in range(12)]
+    serial = qti_bytes(questions, workers=None)
+    assert b'Uploaded%20Media/plot(0, -1).png' in serial
+    assert qti_bytes(questions, workers=2) == serial